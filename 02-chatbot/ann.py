@@ -0,0 +1,223 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+
+from retriever import (
+    TOP_K, BLOCK_ROWS, ExactRetriever, evaluate, prepare_queries, rerank, sample_queries, stack_results,
+    top_k,
+)
+from store import atomic_open, l2_normalize, load_index
+
+# インデックスディレクトリに embeddings.npy と並べて保存する
+IVF_META_FILE = "ivf.json"
+IVF_CENTROIDS_FILE = "ivf_centroids.npy"   # クラスタ中心 (n_lists, D)
+IVF_OFFSETS_FILE = "ivf_offsets.npy"       # 各転置リストの開始位置 (n_lists + 1,)
+IVF_IDS_FILE = "ivf_ids.npy"               # リスト順に並べたチャンク番号 (N,)
+
+N_PROBE = int(os.getenv("IVF_N_PROBE", "8"))
+KMEANS_ITERS = 20
+TRAIN_PER_LIST = 256    # k-meansの学習に使うサンプル数（リスト数あたり）
+
+# 差分更新では学習済みの中心・代表ベクトルをそのまま使い、次のときだけ学習し直す
+RETRAIN_FRACTION = 0.5  # 前回から引き継げない行がこの割合を超えたとき
+DRIFT_TOLERANCE = 0.1   # 新しい行の量子化の質が、学習時よりこの割合以上悪いとき
+DRIFT_MIN_ROWS = TRAIN_PER_LIST   # 新しい行がこれより少なければ、平均がばらつくのでずれでは学習し直さない
+
+
+def default_n_lists(n):
+    # よく使われる目安: sqrt(N) 程度
+    return max(1, int(np.sqrt(n)))
+
+
+def assign(x, centroids, spherical=True, return_scores=False):
+    # 各ベクトルを最も近い中心に割り当てる（sphericalなら内積、そうでなければユークリッド距離）
+    labels = np.empty(len(x), dtype=np.int32)
+    scores = np.empty(len(x), dtype=np.float32)
+    bias = 0.0 if spherical else -0.5 * np.einsum("ij,ij->i", centroids, centroids)
+    for start in range(0, len(x), BLOCK_ROWS):
+        block = np.asarray(x[start:start + BLOCK_ROWS], dtype=np.float32)
+        sims = block @ centroids.T + bias
+        labels[start:start + len(block)] = np.argmax(sims, axis=1)
+        scores[start:start + len(block)] = sims[np.arange(len(block)), labels[start:start + len(block)]]
+    if return_scores:
+        return labels, scores
+    return labels
+
+
+def kmeans(x, n_clusters, iters=KMEANS_ITERS, spherical=True, sample_size=None, seed=0):
+    rng = np.random.default_rng(seed)
+
+    # 大きなコーパスではサンプルだけで学習する
+    if sample_size is not None and len(x) > sample_size:
+        rows = np.sort(rng.choice(len(x), sample_size, replace=False))
+        train = np.asarray(x[rows], dtype=np.float32)
+    else:
+        train = np.asarray(x, dtype=np.float32)
+
+    n_clusters = min(n_clusters, len(train))
+    centroids = train[rng.choice(len(train), n_clusters, replace=False)].copy()
+
+    for _ in range(iters):
+        labels = assign(train, centroids, spherical)
+        counts = np.bincount(labels, minlength=n_clusters)
+
+        # ラベル順に並べて reduceat で各クラスタの和を取る
+        order = np.argsort(labels, kind="stable")
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        nonempty = counts > 0
+        sums = np.add.reduceat(train[order], starts[nonempty], axis=0)
+
+        centroids[nonempty] = sums / counts[nonempty, None]
+        # 空のクラスタはランダムな点で置き直す
+        empty = np.flatnonzero(~nonempty)
+        if len(empty):
+            centroids[empty] = train[rng.choice(len(train), len(empty), replace=False)]
+        if spherical:
+            centroids = l2_normalize(centroids)
+
+    return centroids
+
+
+class IVFIndex:
+    """k-meansで粗くクラスタリングし、クエリに近いn_probe個のリストだけを走査する"""
+
+    def __init__(self, embeddings, centroids, offsets, ids, n_probe=N_PROBE, quality=None):
+        self.embeddings = embeddings
+        self.centroids = centroids
+        self.offsets = offsets
+        self.ids = ids
+        self.n_probe = n_probe
+        self.quality = quality   # 学習時の、各ベクトルと割り当てた中心のコサイン類似度の平均
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, embeddings, n_lists=None, n_probe=N_PROBE, iters=KMEANS_ITERS, seed=0):
+        n_lists = n_lists or default_n_lists(len(embeddings))
+        centroids = kmeans(
+            embeddings, n_lists, iters=iters,
+            sample_size=n_lists * TRAIN_PER_LIST, seed=seed,
+        )
+        labels, scores = assign(embeddings, centroids, return_scores=True)
+        return cls.from_labels(embeddings, centroids, labels, n_probe, float(scores.mean()))
+
+    @classmethod
+    def from_labels(cls, embeddings, centroids, labels, n_probe=N_PROBE, quality=None):
+        # リストごとにチャンク番号を昇順に並べる（mmapの読み込みが前から順になるように）
+        ids = np.argsort(labels, kind="stable").astype(np.int64)
+        counts = np.bincount(labels, minlength=len(centroids))
+        offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        return cls(embeddings, centroids, offsets, ids, n_probe, quality)
+
+    @classmethod
+    def update(cls, previous, embeddings, old_rows, n_probe=N_PROBE):
+        """前回のIVFの中心を学習し直さずに使い、変わった行だけをリストに割り当てる
+
+        old_rows は新しい行ごとの前回の行番号（追加・変更された行は -1）。
+        引き継いだ行は前回と同じリストに入れる。戻り値は (ivf, drift) で、drift は
+        新しい行と中心の類似度が学習時よりどれだけ下がったかの割合（新しい行がなければ 0）。
+        """
+        labels = np.empty(len(embeddings), dtype=np.int32)
+        kept = old_rows >= 0
+        labels[kept] = previous.labels()[old_rows[kept]]
+
+        drift = 0.0
+        changed = np.flatnonzero(~kept)
+        if len(changed):
+            labels[changed], scores = assign(embeddings[changed], previous.centroids, return_scores=True)
+            drift = (previous.quality - float(scores.mean())) / previous.quality
+
+        ivf = cls.from_labels(embeddings, previous.centroids, labels, n_probe, previous.quality)
+        return ivf, drift
+
+    def labels(self):
+        # 行ごとのリスト番号
+        labels = np.empty(len(self.ids), dtype=np.int32)
+        labels[self.ids] = np.repeat(np.arange(self.n_lists, dtype=np.int32), np.diff(self.offsets))
+        return labels
+
+    def save(self, path):
+        with atomic_open(os.path.join(path, IVF_CENTROIDS_FILE)) as f:
+            np.save(f, self.centroids)
+        with atomic_open(os.path.join(path, IVF_OFFSETS_FILE)) as f:
+            np.save(f, self.offsets)
+        with atomic_open(os.path.join(path, IVF_IDS_FILE)) as f:
+            np.save(f, self.ids)
+        with atomic_open(os.path.join(path, IVF_META_FILE), "w", encoding="utf-8") as f:
+            json.dump({"n_lists": self.n_lists, "count": len(self), "quality": self.quality}, f)
+
+    @classmethod
+    def load(cls, index, n_probe=N_PROBE):
+        meta_path = os.path.join(index.path, IVF_META_FILE)
+        if not os.path.exists(meta_path):
+            raise FileNotFoundError(
+                f"{meta_path} がありません。python ann.py {index.path} で作成してください"
+            )
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        # インデックスだけ作り直してIVFが古いままになっていないか確認する
+        if meta["count"] != len(index):
+            raise ValueError(
+                f"IVF index is stale ({meta['count']} != {len(index)} chunks); rebuild with ann.py"
+            )
+
+        return cls(
+            index.embeddings,
+            np.load(os.path.join(index.path, IVF_CENTROIDS_FILE)),
+            np.load(os.path.join(index.path, IVF_OFFSETS_FILE)),
+            np.load(os.path.join(index.path, IVF_IDS_FILE), mmap_mode="r"),
+            n_probe,
+            meta.get("quality"),
+        )
+
+    def probe(self, queries, n_probe=None):
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        _, lists = top_k(queries @ self.centroids.T, n_probe)
+        return lists
+
+    def candidates(self, lists):
+        ids = [self.ids[self.offsets[l]:self.offsets[l + 1]] for l in lists]
+        return np.concatenate(ids) if ids else np.zeros(0, dtype=np.int64)
+
+    def search(self, query_vec, k=TOP_K, n_probe=None):
+        queries, single = prepare_queries(query_vec)
+        results = []
+        for query, lists in zip(queries, self.probe(queries, n_probe)):
+            results.append(rerank(self.embeddings, query, self.candidates(lists), k))
+        return stack_results(results, k, single)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="IVFインデックスを作成し、厳密検索に対するrecallを表示する")
+    parser.add_argument("index", nargs="?", default=os.getenv("INDEX_DIR", "kenji_index"))
+    parser.add_argument("--lists", type=int, default=None, help="リスト数（省略時は sqrt(N)）")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=TOP_K)
+    args = parser.parse_args()
+
+    index = load_index(args.index)
+    start = time.perf_counter()
+    ivf = IVFIndex.build(index.embeddings, args.lists)
+    ivf.save(args.index)
+    print(f"{len(index)} chunks, {ivf.n_lists} lists, built in {time.perf_counter() - start:.1f}s")
+
+    exact = ExactRetriever(index.embeddings)
+    queries = sample_queries(index.embeddings, args.queries)
+    n_probe = 1
+    while True:
+        recall, latency = evaluate(ivf, exact, queries, args.k, n_probe=n_probe)
+        print(f"n_probe={n_probe:4d}  recall@{args.k}={recall:.3f}  {latency:.2f} ms/query")
+        if n_probe >= ivf.n_lists:
+            break
+        n_probe = min(n_probe * 2, ivf.n_lists)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import os
+import time
+import hashlib
+import threading
+import numpy as np
+
+from store import l2_normalize
+
+CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))   # コサイン類似度の下限
+CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))               # 秒
+CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+CONTEXT_MESSAGES = 2    # 会話の文脈として比べる直近の履歴の件数
+
+
+def context_key(history, n=CONTEXT_MESSAGES):
+    # 直近の履歴が同じ会話どうしでだけ回答を使い回す（履歴なしの最初の質問どうしは共有される）
+    h = hashlib.sha1()
+    for message in history[-n:]:
+        h.update(f"{message['role']}\0{message['content']}\0".encode("utf-8"))
+    return h.hexdigest() if history else ""
+
+
+class AnswerCache:
+    """過去の質問ベクトルと回答を保持し、十分に似た質問には保存済みの回答を返す"""
+
+    def __init__(self, threshold=CACHE_THRESHOLD, ttl=CACHE_TTL, max_size=CACHE_SIZE):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        self.vectors = None                       # (max_size, D) 最初の保存時に確保する
+        self.expires = np.zeros(max_size)         # 0 は空きスロット
+        self.last_used = np.zeros(max_size)
+        self.keys = [None] * max_size
+        self.entries = [None] * max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return int(np.count_nonzero(self.expires > time.time()))
+
+    def lookup(self, query_vec, key=""):
+        now = time.time()
+        with self._lock:
+            if self.vectors is None:
+                self.misses += 1
+                return None
+
+            live = self.expires > now
+            self.expires[~live] = 0    # 期限切れは空きスロットに戻す
+            candidates = np.flatnonzero(live)
+            candidates = [i for i in candidates if self.keys[i] == key]
+            if not candidates:
+                self.misses += 1
+                return None
+
+            query = l2_normalize(query_vec)
+            scores = self.vectors[candidates] @ query
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                self.misses += 1
+                return None
+
+            slot = candidates[best]
+            self.last_used[slot] = now
+            self.hits += 1
+            return dict(self.entries[slot], similarity=float(scores[best]))
+
+    def store(self, query_vec, answer, chunk_ids, key=""):
+        now = time.time()
+        query = l2_normalize(query_vec)
+        with self._lock:
+            if self.vectors is None:
+                self.vectors = np.zeros((self.max_size, len(query)), dtype=np.float32)
+
+            # 空きスロットがなければ一番長く使われていないものを追い出す
+            free = np.flatnonzero(self.expires <= now)
+            if len(free):
+                slot = int(free[0])
+            else:
+                slot = int(np.argmin(self.last_used))
+                self.evictions += 1
+
+            self.vectors[slot] = query
+            self.expires[slot] = now + self.ttl
+            self.last_used[slot] = now
+            self.keys[slot] = key
+            self.entries[slot] = {
+                "answer": answer,
+                "chunk_ids": [int(i) for i in chunk_ids],
+            }
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+def format_stats(stats):
+    return (
+        f"answer cache | hits: {stats['hits']}, misses: {stats['misses']}, "
+        f"hit rate: {stats['hit_rate']:.1%}, size: {stats['size']}, evictions: {stats['evictions']}"
+    )
@@ -1,46 +1,120 @@
 import os
-import json
-import numpy as np
+import time
 import streamlit as st
 from dotenv import load_dotenv
 from openai import OpenAI
 
+from answer_cache import AnswerCache, format_stats
+from embed_cache import EmbeddingCache, format_embed_stats
+from engine import ChatEngine, Conversation
+from gate import RetrievalGate, format_gate_stats
+from llm import format_usage
+from metrics import Metrics
+from prompt import format_plan, is_context
+from ratelimit import format_scheduler_stats, get_scheduler
+from retriever import make_retriever
+from store import load_index
+
 load_dotenv()
 
 API_KEY = os.getenv("OPENAI_API_KEY")
 MODEL_NAME = os.getenv("MODEL_NAME")
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL")
+INDEX_DIR = os.getenv("INDEX_DIR", "kenji_index")
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "exact")
+DIVERSIFY = os.getenv("DIVERSIFY", "0") != "0"   # 1 なら似た参考文章・同じ作品ばかりにならないよう選び直す
+TOP_K = 3
 
-client = OpenAI(api_key=API_KEY)
 
-st.set_page_config(page_title="宮沢賢治 チャットボット", layout="centered")
-st.title("宮沢賢治 チャットボット")
+# インデックスとクライアントはサーバープロセスで1回だけ作り、全セッションで共有する（読み取り専用）
+@st.cache_resource
+def get_client():
+    # リトライはスケジューラが行う（SDK側でも繰り返すと枠や優先度を通らない呼び出しが増える）
+    return OpenAI(api_key=API_KEY, max_retries=0)
+
+
+@st.cache_resource
+def get_answer_cache():
+    # 回答キャッシュも全セッションで共有する（似た質問は別のユーザーからも来るため）
+    return AnswerCache()
+
+
+@st.cache_resource
+def get_embed_cache():
+    return EmbeddingCache()
 
-# セッション初期化
-if "history" not in st.session_state:
-    st.session_state.history = []
 
-if "loaded" not in st.session_state:
-    with open("kenji_embeddings.json", encoding="utf-8") as f:
-        data = json.load(f)
+@st.cache_resource
+def get_gate():
+    # 検索するかどうかの判定（判定の記録と件数は全セッション分をまとめる）
+    return RetrievalGate()
 
-    chunks = [{"text": d["text"], "source": d["source"]} for d in data]
-    embeddings = np.array([d["embedding"] for d in data], dtype=np.float32)
-    norm_embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
 
-    st.session_state.chunks = chunks
-    st.session_state.norm_embeddings = norm_embeddings
-    st.session_state.loaded = True
+@st.cache_resource
+def get_metrics():
+    # 区間ごとの所要時間とトークン数（全セッション分をまとめて集計する）
+    return Metrics()
 
 
-# システムプロンプト
-system_prompt = """
-あなたは宮沢賢治の文体・語彙・世界観を強く反映して話す対話AIです。
-自然、宇宙、心象風景を大切にし、詩的だが会話として自然な返答をしてください。
-"""
+@st.cache_resource(show_spinner="インデックスを読み込んでいます…")
+def get_corpus():
+    # 正規化済みのベクトルをmmapで読み込む
+    start = time.perf_counter()
+    index = load_index(INDEX_DIR)
+    retriever = make_retriever(index, RETRIEVAL_MODE, diversify=DIVERSIFY)
+    get_metrics().observe("index_load", (time.perf_counter() - start) * 1000)
+    # 読み込みごとに変わる世代番号（他のセッションが読み込み直したことを各セッションで検知する）
+    generation = time.time_ns()
+    return index.chunks, retriever, generation
 
-# チャット履歴表示
-for msg in st.session_state.history:
+
+st.set_page_config(page_title="宮沢賢治 チャットボット", layout="centered")
+st.title("宮沢賢治 チャットボット")
+
+client = get_client()
+chunks, retriever, generation = get_corpus()
+answer_cache = get_answer_cache()
+embed_cache = get_embed_cache()
+metrics = get_metrics()
+gate = get_gate()
+# 上流への呼び出しはすべてスケジューラを通す（全セッションで同じ枠を共有する）
+scheduler = get_scheduler()
+
+# インデックスを作り直した後に、サーバーを再起動せずに読み込み直す
+with st.sidebar:
+    if st.button("インデックスを再読み込み"):
+        get_corpus.clear()
+        get_answer_cache.clear()
+        st.rerun()
+    st.caption(format_stats(answer_cache.stats()))
+    st.caption(format_embed_stats(embed_cache.stats()))
+    st.caption(format_scheduler_stats(scheduler.stats()))
+    st.caption(format_gate_stats(gate.stats()))
+    with st.expander("metrics"):
+        st.code(metrics.summary(), language=None)
+
+# セッションには会話（履歴と直前に検索した参考文章の番号）だけを持つ
+if "conversation" not in st.session_state:
+    st.session_state.conversation = Conversation()
+conversation = st.session_state.conversation
+
+# インデックスは全セッションで共有しているので、どのセッションで読み込み直された場合でも、
+# 古いインデックスの文章番号と履歴に残した参考文章を捨てる
+if st.session_state.get("index_generation") != generation:
+    st.session_state.index_generation = generation
+    conversation.forget_context()
+
+# 検索＋生成は engine.py で行う（CLI・サーバーと共通）
+engine = ChatEngine(
+    client, chunks, retriever, MODEL_NAME, EMBEDDING_MODEL,
+    answer_cache, embed_cache, gate, metrics, scheduler, top_k=TOP_K,
+)
+
+
+# チャット履歴表示（履歴に残した参考文章は表示しない）
+for msg in conversation.history:
+    if is_context(msg):
+        continue
     with st.chat_message(msg["role"]):
         st.write(msg["content"])
 
@@ -53,38 +127,23 @@ if user_input:
     with st.chat_message("user"):
         st.write(user_input)
 
-    # ---- embedding ----
-    res = client.embeddings.create(
-        model=EMBEDDING_MODEL,
-        input=user_input
-    )
-    query_embedding = np.array(res.data[0].embedding)
-    norm_query = query_embedding / np.linalg.norm(query_embedding)
-
-    # ---- 検索 ----
-    scores = np.dot(st.session_state.norm_embeddings, norm_query)
-    top_indices = np.argsort(scores)[::-1][:3]
-    retrieved_texts = [st.session_state.chunks[i] for i in top_indices]
-    context = "\n\n".join(c["text"] for c in retrieved_texts)
-
-    # ---- LLM ----
-    response = client.chat.completions.create(
-        model=MODEL_NAME,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "system", "content": f"参考文章:\n{context}"},
-            *st.session_state.history,
-            {"role": "user", "content": user_input}
-        ]
-    )
-
-    reply = response.choices[0].message.content
-
-    # アシスタント表示
-    with st.chat_message("assistant"):
-        st.write(reply)
+    result = {}
+
+    def deltas(events):
+        # 生成された分だけを表示に回し、最後の結果は取っておく
+        for event, data in events:
+            if event == "delta":
+                yield data
+            else:
+                result.update(data)
 
-    # 履歴保存
-    st.session_state.history.append({"role": "user", "content": user_input})
-    st.session_state.history.append({"role": "assistant", "content": reply})
-    st.session_state.history = st.session_state.history[-10:]
+    # アシスタント表示（生成された分から順に表示する）
+    with st.chat_message("assistant"):
+        st.write_stream(deltas(engine.reply(conversation, user_input)))
+        if result["cached"]:
+            st.caption(f"answer cache hit | similarity: {result['similarity']:.3f}")
+        else:
+            if result["usage"] is not None:
+                st.caption(format_usage(result["usage"]))
+            st.caption(format_plan(result["plan"], result["usage"]))
+            st.caption(f"retrieval gate | {result['gate']['action']} ({result['gate']['reason']})")
@@ -0,0 +1,223 @@
+import os
+import gc
+import json
+import time
+import argparse
+import platform
+
+import numpy as np
+
+from ann import IVFIndex
+from pq import PQIndex
+from quant import ScalarQuantizedIndex
+from retriever import BLOCK_ROWS, TOP_K, ExactRetriever, make_retriever, prepare_queries, recall_at_k, sample_queries
+from store import (
+    EMBEDDINGS_FILE, META_FILE, OFFSETS_FILE, SOURCE_IDS_FILE, TEXTS_FILE, atomic_open, l2_normalize, load_index,
+)
+
+# 合成コーパスの既定値（本番の text-embedding-3-small と同じ次元）
+DIM = int(os.getenv("EMBEDDING_DIM", "1536"))
+SIZES = "1000,10000,100000"        # 10M行（float32で約60GB）まで指定できる
+MODES = ("argsort", "exact", "int8", "ivf", "pq")
+N_CLUSTERS = 256                   # 合成データのクラスタ数（一様乱数より実際の分布に近づける）
+CLUSTER_NOISE = 0.6
+
+# 全件走査では (クエリ数, 行数) の行列を、score(float32)・top_k の符号反転(float32)・argpartition(int64) の
+# 3つ持つので、1回にまとめるクエリ数をこの上限に収める（10M行なら3件ずつ）
+SCORE_MEMORY = 512 * 2**20
+BYTES_PER_SCORE = 16
+
+# モードごとに embeddings.npy 以外に読むファイルの接頭辞
+MODE_FILES = {"ivf": "ivf_", "int8": "sq_int8", "pq": "pq_"}
+
+
+class ArgsortRetriever(ExactRetriever):
+    """以前の chat_bot.py と同じ np.dot + 全件 argsort（比較の基準）"""
+
+    def search(self, query_vec, k=TOP_K):
+        queries, single = prepare_queries(query_vec)
+        scores = self.score(queries)
+        ids = np.argsort(-scores, axis=-1)[:, :k]
+        scores = np.take_along_axis(scores, ids, axis=-1)
+        if single:
+            return scores[0], ids[0]
+        return scores, ids
+
+
+def write_synthetic_index(path, n, dim=DIM, seed=0):
+    # 正規化済みのベクトルだけを持つインデックスを、ブロックごとにディスクへ書く（全体をメモリに載せない）
+    meta_path = os.path.join(path, META_FILE)
+    if os.path.exists(meta_path):
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta["count"] == n and meta["dim"] == dim:
+            return
+
+    os.makedirs(path, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    centers = l2_normalize(rng.normal(size=(N_CLUSTERS, dim)))
+
+    embeddings = np.lib.format.open_memmap(
+        os.path.join(path, EMBEDDINGS_FILE), mode="w+", dtype=np.float32, shape=(n, dim)
+    )
+    for start in range(0, n, BLOCK_ROWS):
+        rows = min(BLOCK_ROWS, n - start)
+        block = centers[rng.integers(0, N_CLUSTERS, rows)]
+        block = block + rng.normal(scale=CLUSTER_NOISE / np.sqrt(dim), size=(rows, dim))
+        embeddings[start:start + rows] = l2_normalize(block)
+    embeddings.flush()
+    del embeddings
+
+    # 本文は空にしておく（load_index で読めるように形だけそろえる）
+    open(os.path.join(path, TEXTS_FILE), "wb").close()
+    np.save(os.path.join(path, OFFSETS_FILE), np.zeros(n + 1, dtype=np.int64))
+    np.save(os.path.join(path, SOURCE_IDS_FILE), np.zeros(n, dtype=np.int32))
+    with atomic_open(meta_path, "w", encoding="utf-8") as f:
+        json.dump({"count": n, "dim": dim, "dtype": "float32", "sources": ["synthetic"]}, f)
+
+
+def build_mode(index, mode):
+    # 検索に必要な補助インデックスを作って保存する（作る必要がなければ 0 秒）
+    start = time.perf_counter()
+    if mode == "ivf":
+        IVFIndex.build(index.embeddings).save(index.path)
+    elif mode == "int8":
+        ScalarQuantizedIndex.build(index.embeddings, mode).save(index.path)
+    elif mode == "pq":
+        PQIndex.build(index.embeddings).save(index.path)
+    return time.perf_counter() - start
+
+
+def load_mode(path, mode):
+    index = load_index(path)
+    if mode == "argsort":
+        return ArgsortRetriever(index.embeddings)
+    return make_retriever(index, mode)
+
+
+def index_bytes(path, mode):
+    prefix = MODE_FILES.get(mode)
+    if prefix is None:
+        return 0
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path) if f.startswith(prefix))
+
+
+def resident_bytes():
+    # Linux のみ: 現在の常駐メモリ（mmapで読み込んだページを含む）
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def query_block(n):
+    # 行数 n のインデックスを全件走査するとき、メモリの上限内で1回にまとめられるクエリ数
+    return max(1, SCORE_MEMORY // (n * BYTES_PER_SCORE))
+
+
+def blocked_search(retriever, queries, k, block):
+    # クエリを block 件ずつに分けて検索し、ids を (Q, k) にまとめて返す
+    ids = [retriever.search(queries[start:start + block], k)[1] for start in range(0, len(queries), block)]
+    return np.concatenate(ids)
+
+
+def percentile_ms(values, q):
+    return float(np.percentile(values, q) * 1000)
+
+
+def bench_mode(path, mode, queries, exact_ids, k, batch_size):
+    build_s = build_mode(load_index(path), mode)
+
+    gc.collect()
+    rss_before = resident_bytes()
+    start = time.perf_counter()
+    retriever = load_mode(path, mode)
+    load_s = time.perf_counter() - start
+
+    # 1件ずつ（対話中の1ターンに相当）
+    latencies = []
+    ids = []
+    for query in queries:
+        start = time.perf_counter()
+        _, found = retriever.search(query, k)
+        latencies.append(time.perf_counter() - start)
+        ids.append(found)
+
+    # まとめて（サーバーのマイクロバッチに相当）。大きなインデックスではメモリの上限に合わせて分けて行う
+    batch = queries[:batch_size]
+    block = query_block(len(retriever))
+    start = time.perf_counter()
+    blocked_search(retriever, batch, k, block)
+    batch_s = time.perf_counter() - start
+
+    rss_after = resident_bytes()
+    return {
+        "mode": mode,
+        "build_s": build_s,
+        "load_s": load_s,
+        "index_bytes": index_bytes(path, mode),
+        "rss_delta_bytes": rss_after - rss_before if rss_before is not None else None,
+        "single_p50_ms": percentile_ms(latencies, 50),
+        "single_p95_ms": percentile_ms(latencies, 95),
+        "batch_size": len(batch),
+        "batch_block": min(block, len(batch)),
+        "batch_ms": batch_s * 1000,
+        "batch_per_query_ms": batch_s * 1000 / len(batch),
+        f"recall@{k}": float(np.mean([recall_at_k(a, e) for a, e in zip(ids, exact_ids)])),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="合成コーパスで検索方式ごとの読み込み時間・レイテンシ・メモリ・recallを測る")
+    parser.add_argument("--sizes", default=SIZES, help="行数（カンマ区切り）。例: 1000,10000,100000,1000000,10000000")
+    parser.add_argument("--dim", type=int, default=DIM)
+    parser.add_argument("--modes", default=",".join(MODES), help=f"測る方式（カンマ区切り）: {','.join(MODES)}")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("-k", type=int, default=TOP_K)
+    parser.add_argument("--data-dir", default="bench_data", help="合成インデックスの置き場所（次回以降は再利用する）")
+    parser.add_argument("--out", default="bench_retrieval.jsonl", help="結果を1行1件で追記するJSONL")
+    parser.add_argument("--label", default="", help="結果に付ける名前（バージョン間の比較用）")
+    args = parser.parse_args()
+
+    modes = args.modes.split(",")
+    unknown = set(modes) - set(MODES)
+    if unknown:
+        parser.error(f"unknown modes: {sorted(unknown)}")
+
+    run = {
+        "label": args.label,
+        "time": time.time(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+    for n in (int(s) for s in args.sizes.split(",")):
+        path = os.path.join(args.data_dir, f"synthetic_{n}_{args.dim}")
+        start = time.perf_counter()
+        write_synthetic_index(path, n, args.dim)
+        print(f"{n} x {args.dim} ({n * args.dim * 4 / 2**20:.0f} MiB) ready in {time.perf_counter() - start:.1f}s")
+
+        index = load_index(path)
+        queries = sample_queries(index.embeddings, args.queries)
+        exact_ids = blocked_search(ExactRetriever(index.embeddings), queries, args.k, query_block(n))
+        del index
+
+        for mode in modes:
+            row = dict(run, rows=n, dim=args.dim, k=args.k,
+                       **bench_mode(path, mode, queries, exact_ids, args.k, args.batch_size))
+            print(
+                f"  {mode:<8} load {row['load_s'] * 1000:8.1f}ms  "
+                f"single p50 {row['single_p50_ms']:8.2f}ms p95 {row['single_p95_ms']:8.2f}ms  "
+                f"batch {row['batch_per_query_ms']:8.3f}ms/query  "
+                f"index {row['index_bytes'] / 2**20:8.1f}MiB  recall@{args.k} {row[f'recall@{args.k}']:.3f}"
+            )
+            with open(args.out, "a", encoding="utf-8") as f:
+                f.write(json.dumps(row) + "\n")
+
+
+if __name__ == "__main__":
+    main()
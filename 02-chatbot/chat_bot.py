@@ -1,85 +1,84 @@
 import os
-import json
-import numpy as np
+import time
 from dotenv import load_dotenv
 from openai import OpenAI
 
+from answer_cache import AnswerCache, format_stats
+from embed_cache import EmbeddingCache, format_embed_stats
+from engine import ChatEngine, Conversation
+from gate import RetrievalGate, format_gate_stats
+from llm import format_usage
+from metrics import Metrics
+from prompt import format_plan
+from ratelimit import format_scheduler_stats, get_scheduler
+from retriever import make_retriever
+from store import load_index
+
 load_dotenv()
 
 API_KEY=os.getenv("OPENAI_API_KEY")
 MODEL_NAME = os.getenv("MODEL_NAME")
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL")
-client = OpenAI(api_key=API_KEY)
+# リトライはスケジューラが行う（SDK側でも繰り返すと枠や優先度を通らない呼び出しが増える）
+client = OpenAI(api_key=API_KEY, max_retries=0)
 
 
-# チャンクごとにベクトル化したデータをJSONで読み込む
-with open("kenji_embeddings.json", encoding="utf-8") as f:
-    data = json.load(f)
+INDEX_DIR = os.getenv("INDEX_DIR", "kenji_index")
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "exact")
+DIVERSIFY = os.getenv("DIVERSIFY", "0") != "0"   # 1 なら似た参考文章・同じ作品ばかりにならないよう選び直す
+TOP_K = 3
 
-chunks = [{"text": d["text"], "source": d["source"]} for d in data]
-embeddings = np.array([d["embedding"] for d in data], dtype=np.float32)
 
-# L2ノルム正規化処理
-norm_embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+# 区間ごとの所要時間とトークン数を記録する（ターンごとに metrics.jsonl へ追記）
+metrics = Metrics()
 
+# 正規化済みのベクトルをmmapで読み込む（JSONからの変換は store.py で行う）
+start = time.perf_counter()
+index = load_index(INDEX_DIR)
+chunks = index.chunks
+retriever = make_retriever(index, RETRIEVAL_MODE, diversify=DIVERSIFY)
+metrics.observe("index_load", (time.perf_counter() - start) * 1000)
+answer_cache = AnswerCache()
+embed_cache = EmbeddingCache()
+# 上流への呼び出しはすべてスケジューラを通す（RPM/TPMの枠とリトライ）
+scheduler = get_scheduler()
+# あいさつや「もっと詳しく」のようなターンでは検索しない
+gate = RetrievalGate()
 
-# メイン処理（検索＋生成）
-history = []
 
-system_prompt = """
-あなたは宮沢賢治の文体・語彙・世界観を強く反映して話す対話AIです。
-自然、宇宙、心象風景を大切にし、詩的だが会話として自然な返答をしてください。
-"""
+# メイン処理（検索＋生成は engine.py で行う）
+engine = ChatEngine(
+    client, chunks, retriever, MODEL_NAME, EMBEDDING_MODEL,
+    answer_cache, embed_cache, gate, metrics, scheduler, top_k=TOP_K,
+)
+conversation = Conversation()
 
 while True:
     user_input = input("あなた：")
     if user_input == "さようなら。":
+        print(format_stats(answer_cache.stats()))
+        print(format_embed_stats(embed_cache.stats()))
+        print(format_scheduler_stats(scheduler.stats()))
+        print(format_gate_stats(gate.stats()))
+        print(metrics.summary())
         break
 
-    # 入力トークンに対するembedding
-    res = client.embeddings.create(
-        model=EMBEDDING_MODEL,
-        input=user_input
-    )
-    query_embedding = np.array(res.data[0].embedding)
-
-    # コサイン類似度でscore化し検索
-    norm_query = query_embedding / np.linalg.norm(query_embedding)
-
-    scores = np.dot(norm_embeddings, norm_query)
-    top_indices = np.argsort(scores)[::-1][:3] # 意味的に一番近い文章を上位3つ選ぶ
-    retrieved_texts = [chunks[i] for i in top_indices]
-
-    context = "\n\n".join(c["text"] for c in retrieved_texts)
-
-    # LLMによる回答の生成
-    response = client.chat.completions.create(
-        model=MODEL_NAME,
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "system", "content": f"参考文章:\n{context}"},
-            *history,
-            {"role": "user", "content": user_input}
-        ]
-    )
-
-    reply = response.choices[0].message.content
-    print("賢治bot：", reply)
-
-    # 使用トークン数のカウント
-    usage = response.usage
-    print(
-        f"tokens | input: {usage.prompt_tokens}, "
-        f"output: {usage.completion_tokens}, "
-        f"total: {usage.total_tokens}"
-    )
-
-    history.append({"role": "user", "content": user_input})
-    history.append({"role": "assistant", "content": reply})
-    history = history[-10:]
+    # 生成された分から順に表示する
+    print("賢治bot： ", end="", flush=True)
+    for event, data in engine.reply(conversation, user_input):
+        if event == "delta":
+            print(data, end="", flush=True)
+        else:
+            result = data
+    print()
+
+    if result["cached"]:
+        print(f"answer cache hit | similarity: {result['similarity']:.3f}")
+    else:
+        # 使用トークン数のカウント
+        if result["usage"] is not None:
+            print(format_usage(result["usage"]))
+        print(format_plan(result["plan"], result["usage"]))
+        print(f"retrieval gate | {result['gate']['action']} ({result['gate']['reason']})")
 
     # 1回の問い合わせで約0.7円
-
-
-
-
@@ -0,0 +1,120 @@
+import os
+import json
+import argparse
+
+import numpy as np
+from dotenv import load_dotenv
+from openai import OpenAI
+
+from corpus import SENTENCE, TEXT_DIR, chunk_source, clean_text_with_offsets, read_sources
+from embed_cache import EmbeddingCache
+from lexical import BM25Index
+from ratelimit import BULK, get_scheduler
+from retriever import TOP_K, ExactRetriever
+from store import l2_normalize
+from tokens import count_tokens
+
+load_dotenv()
+
+API_KEY = os.getenv("OPENAI_API_KEY")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL")
+
+MIN_QUERY_CHARS = 15   # これより短い文はクエリにしない
+MAX_QUERY_CHARS = 60
+
+
+def sample_queries(sources, n, seed=0):
+    # 本文中の文をクエリにし、その文の元ファイル内の位置を正解とする
+    candidates = []
+    for item in sources:
+        text, to_raw = clean_text_with_offsets(item["text"])
+        for m in SENTENCE.finditer(text):
+            if len(m.group()) >= MIN_QUERY_CHARS:
+                candidates.append((item["filename"], to_raw(m.start()), m.group()[:MAX_QUERY_CHARS]))
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(candidates), min(n, len(candidates)), replace=False)
+    return [candidates[i] for i in sorted(rows)]
+
+
+def hit_rate(chunks, queries, results):
+    # 上位k件のどれかが、クエリの文を含むチャンクなら当たり
+    hits = 0
+    for (source, offset, _), ids in zip(queries, results):
+        hits += any(
+            chunks[i]["source"] == source and chunks[i]["start"] <= offset < chunks[i]["end"]
+            for i in ids
+        )
+    return hits / len(queries)
+
+
+def search_bm25(chunks, queries, k):
+    bm25 = BM25Index.build([c["text"] for c in chunks])
+    return [bm25.search(text, k)[1] for _, _, text in queries]
+
+
+def search_dense(chunks, queries, k, client, cache):
+    # 同じチャンクは設定をまたいでキャッシュから返す（重なりのある設定でも再計算しない）
+    scheduler = get_scheduler()
+    vectors = cache.embed(client, EMBEDDING_MODEL, [c["text"] for c in chunks], scheduler, BULK)
+    query_vectors = cache.embed(client, EMBEDDING_MODEL, [text for _, _, text in queries], scheduler, BULK)
+    exact = ExactRetriever(l2_normalize(np.stack(vectors)))
+    _, ids = exact.search(np.stack(query_vectors), k)
+    return list(ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="チャンク分割の設定ごとにチャンク数・embeddingのトークン数・検索の当たり率を比べる")
+    parser.add_argument("text_dir", nargs="?", default=TEXT_DIR)
+    parser.add_argument("--tokens", default="200,300,400,600", help="チャンクのトークン数の上限（カンマ区切り）")
+    parser.add_argument("--overlaps", default="0,50,100", help="重ねるトークン数（カンマ区切り）")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=TOP_K)
+    parser.add_argument("--retriever", choices=("dense", "bm25"), default="dense",
+                        help="dense は embedding API を使う（結果はキャッシュされる）。bm25 はAPIなしで試せるが本文をそのまま"
+                             "クエリにするので当たり率は高めに出る")
+    parser.add_argument("--out", help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    sources = list(read_sources(args.text_dir))
+    queries = sample_queries(sources, args.queries)
+    if args.retriever == "dense":
+        client = OpenAI(api_key=API_KEY, max_retries=0)
+        cache = EmbeddingCache()
+
+    rows = []
+    for max_tokens in (int(t) for t in args.tokens.split(",")):
+        for overlap in (int(o) for o in args.overlaps.split(",")):
+            if overlap >= max_tokens:
+                continue
+            chunks = [
+                c for item in sources
+                for c in chunk_source(item["text"], item["filename"], max_tokens, overlap, EMBEDDING_MODEL)
+            ]
+            if args.retriever == "dense":
+                results = search_dense(chunks, queries, args.k, client, cache)
+            else:
+                results = search_bm25(chunks, queries, args.k)
+
+            tokens = sum(count_tokens(c["text"], EMBEDDING_MODEL) for c in chunks)
+            row = {
+                "max_tokens": max_tokens,
+                "overlap": overlap,
+                "chunks": len(chunks),
+                "embedding_tokens": tokens,
+                "mean_chunk_tokens": tokens / max(len(chunks), 1),
+                "hit_rate": hit_rate(chunks, queries, results),
+            }
+            rows.append(row)
+            print(
+                f"tokens={max_tokens:4d} overlap={overlap:4d}  {row['chunks']:6d} chunks  "
+                f"{tokens:8d} embedding tokens ({row['mean_chunk_tokens']:.0f}/chunk)  "
+                f"hit@{args.k}={row['hit_rate']:.3f}"
+            )
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"retriever": args.retriever, "k": args.k, "queries": len(queries), "results": rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
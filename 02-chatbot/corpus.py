@@ -0,0 +1,194 @@
+import os
+import re
+import hashlib
+import argparse
+import bisect
+
+from tokens import count_tokens, token_cuts
+
+TEXT_DIR = "kenji_novels"
+CHUNK_TOKENS = 400    # 1チャンクのトークン数の上限（embeddingのトークナイザで数える）
+CHUNK_OVERLAP = 50    # 前のチャンクの末尾から持ち越す文のトークン数
+NORMALIZER_VERSION = 2   # 前処理を変えたら上げる（ingest.py が全件作り直す）
+
+# 青空文庫の注記を1回の置換でまとめて消す
+#   《ルビ》: 読み仮名は本文と重複するので読みごと消す  例: 兎《うさぎ》 → 兎
+#   ｜: ルビのかかる範囲の開始記号
+#   ※［＃…］: 入力者注（字下げ・外字の説明など）
+#   全角スペース・改行・CR
+AOZORA_MARKUP = re.compile(r"《[^》]*》|※?［＃[^］]*］|[｜\u3000\r\n]")
+
+# 以前の前処理（記号だけ消して読み仮名は残す）。normalization_report の比較用
+LEGACY_MARKUP = str.maketrans("", "", "｜《》\u3000\n")
+
+# 文の区切り（閉じかっこは前の文に含める）
+SENTENCE = re.compile(r"[^。！？]*[。！？]+[」』）]*|[^。！？]+$")
+
+
+def clean_text(text):
+    # --- 前処理 ---
+    return AOZORA_MARKUP.sub("", text)
+
+
+def clean_text_with_offsets(text):
+    # 前処理後の文字列と、前処理後の位置を元のテキストの位置に戻す関数を返す
+    parts = []
+    clean_starts = []
+    raw_starts = []
+    pos = 0
+    length = 0
+    for m in AOZORA_MARKUP.finditer(text):
+        if m.start() > pos:
+            parts.append(text[pos:m.start()])
+            clean_starts.append(length)
+            raw_starts.append(pos)
+            length += m.start() - pos
+        pos = m.end()
+    if pos < len(text):
+        parts.append(text[pos:])
+        clean_starts.append(length)
+        raw_starts.append(pos)
+
+    def to_raw(offset):
+        i = max(bisect.bisect_right(clean_starts, offset) - 1, 0)
+        return raw_starts[i] + offset - clean_starts[i] if raw_starts else 0
+
+    return "".join(parts), to_raw
+
+
+def normalization_report(text_dir=TEXT_DIR, model=None):
+    # ファイルごとに、以前の前処理と比べて文字数・トークン数がどれだけ減ったか
+    rows = []
+    for item in read_sources(text_dir):
+        before = item["text"].translate(LEGACY_MARKUP)
+        after = clean_text(item["text"])
+        rows.append({
+            "filename": item["filename"],
+            "chars_before": len(before),
+            "chars_after": len(after),
+            "tokens_before": count_tokens(before, model),
+            "tokens_after": count_tokens(after, model),
+        })
+    return rows
+
+
+def iter_source_files(text_dir=TEXT_DIR):
+    # 実行ごとに順番が変わらないようパス順に、サブディレクトリも含めて (text_dir からの相対パス, パス) を返す
+    for root, dirs, files in os.walk(text_dir):
+        dirs.sort()
+        for filename in sorted(files):
+            if filename.endswith(".txt"):
+                path = os.path.join(root, filename)
+                yield os.path.relpath(path, text_dir), path
+
+
+def read_sources(text_dir=TEXT_DIR):
+    # 1ファイルずつ読む（コーパス全体を一度にメモリに載せない）
+    for filename, filepath in iter_source_files(text_dir):
+        with open(filepath, "rb") as f:
+            data = f.read()
+
+        yield {
+            "filename": filename,
+            "hash": hashlib.sha256(data).hexdigest(),
+            "text": data.decode("utf-8"),
+        }
+
+
+def read_texts(text_dir=TEXT_DIR):
+    for item in read_sources(text_dir):
+        yield {
+            "filename": item["filename"],
+            "text": clean_text(item["text"]),
+        }
+
+
+def sentence_pieces(text, max_tokens, model=None):
+    # (開始位置, 終了位置, トークン数) を文ごとに返す。上限より長い文は上限ごとに切る
+    for m in SENTENCE.finditer(text):
+        start, end = m.span()
+        if start == end:
+            continue
+        tokens = count_tokens(text[start:end], model)
+        if tokens <= max_tokens:
+            yield start, end, tokens
+            continue
+        # 句点のない長い文（改行を除いた詩など）は1回だけエンコードし、トークン位置で切る
+        cuts = [start + cut for cut in token_cuts(text[start:end], max_tokens, model)]
+        for piece_start, piece_end in zip([start] + cuts, cuts + [end]):
+            yield piece_start, piece_end, count_tokens(text[piece_start:piece_end], model)
+
+
+def iter_chunks(text, source, max_tokens=CHUNK_TOKENS, overlap=CHUNK_OVERLAP, model=None):
+    """文を単位に max_tokens トークンまで詰めたチャンクを順に返す
+
+    次のチャンクの先頭には、前のチャンクの末尾から overlap トークン以内の文を重ねる。
+    チャンクは text の部分文字列で、start・end は text 内の位置。
+    """
+    overlap = min(overlap, max_tokens // 2)
+    window = []     # (開始位置, 終了位置, トークン数)
+    used = 0
+    fresh = False   # 前のチャンクから持ち越した文以外を含むか
+
+    for piece in sentence_pieces(text, max_tokens, model):
+        if fresh and used + piece[2] > max_tokens:
+            yield {"text": text[window[0][0]:window[-1][1]], "source": source,
+                   "start": window[0][0], "end": window[-1][1]}
+            kept = []
+            used = 0
+            for previous in reversed(window):
+                if used + previous[2] > overlap or used + previous[2] + piece[2] > max_tokens:
+                    break
+                kept.append(previous)
+                used += previous[2]
+            window = kept[::-1]
+        window.append(piece)
+        used += piece[2]
+        fresh = True
+
+    if fresh:
+        yield {"text": text[window[0][0]:window[-1][1]], "source": source,
+               "start": window[0][0], "end": window[-1][1]}
+
+
+def split_chunks(text, source, max_tokens=CHUNK_TOKENS, overlap=CHUNK_OVERLAP, model=None):
+    return list(iter_chunks(text, source, max_tokens, overlap, model))
+
+
+def chunk_source(raw_text, source, max_tokens=CHUNK_TOKENS, overlap=CHUNK_OVERLAP, model=None):
+    # 前処理してからチャンクに分け、start・end を元のファイル（デコード後の文字列）内の位置に直す
+    text, to_raw = clean_text_with_offsets(raw_text)
+    chunks = []
+    for chunk in iter_chunks(text, source, max_tokens, overlap, model):
+        chunk["start"] = to_raw(chunk["start"])
+        chunk["end"] = to_raw(chunk["end"] - 1) + 1
+        chunks.append(chunk)
+    return chunks
+
+
+def load_chunks(text_dir=TEXT_DIR, max_tokens=CHUNK_TOKENS, overlap=CHUNK_OVERLAP, model=None):
+    chunks = []
+    for item in read_sources(text_dir):
+        chunks.extend(chunk_source(item["text"], item["filename"], max_tokens, overlap, model))
+    return chunks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="前処理（ルビ・注記の除去）で減る文字数・トークン数をファイルごとに表示する")
+    parser.add_argument("text_dir", nargs="?", default=TEXT_DIR)
+    parser.add_argument("--model", default=os.getenv("EMBEDDING_MODEL"))
+    args = parser.parse_args()
+
+    rows = normalization_report(args.text_dir, args.model)
+    totals = {k: sum(r[k] for r in rows) for k in ("chars_before", "chars_after", "tokens_before", "tokens_after")}
+    for r in rows + [dict(totals, filename="total")]:
+        print(
+            f"{r['filename']:<32} chars {r['chars_before']:>7d} -> {r['chars_after']:>7d} "
+            f"(-{1 - r['chars_after'] / max(r['chars_before'], 1):.1%})  "
+            f"tokens {r['tokens_before']:>7d} -> {r['tokens_after']:>7d} "
+            f"(-{1 - r['tokens_after'] / max(r['tokens_before'], 1):.1%})"
+        )
+
+
+if __name__ == "__main__":
+    main()
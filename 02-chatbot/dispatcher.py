@@ -0,0 +1,93 @@
+import os
+import asyncio
+
+import numpy as np
+
+MAX_BATCH_SIZE = int(os.getenv("BATCH_MAX_SIZE", "64"))
+MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "5"))
+
+
+class MicroBatcher:
+    """数ミリ秒のあいだに届いた要求をまとめて handler(items) に渡し、結果をそれぞれの呼び出し元に返す
+
+    handler は items と同じ順番・同じ長さの結果のリストを返す async 関数。
+    max_wait_ms は最初の要求が待たされる上限で、これで遅延の悪化を抑える。
+    """
+
+    def __init__(self, handler, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS):
+        self.handler = handler
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.batches = 0
+        self.items = 0
+        self._queue = None
+        self._task = None
+        self._dispatching = set()   # 実行中のタスクがGCされないよう参照を持っておく
+
+    async def submit(self, item):
+        # イベントループ上で初めて呼ばれたときに集約用のタスクを起動する
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._collect())
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # 処理を待たずに次のバッチを集め始める
+            task = asyncio.create_task(self._dispatch(batch))
+            self._dispatching.add(task)
+            task.add_done_callback(self._dispatching.discard)
+
+    async def _dispatch(self, batch):
+        self.batches += 1
+        self.items += len(batch)
+        try:
+            results = await self.handler([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": self.items / self.batches if self.batches else 0.0,
+        }
+
+
+def embedding_batcher(client, model, cache, semaphore=None, scheduler=None, **kwargs):
+    # 同時に届いた質問を1回の embeddings.create にまとめる（キャッシュにあるものは送らない）
+    async def handler(texts):
+        if semaphore is None:
+            return await cache.aembed(client, model, texts, scheduler)
+        async with semaphore:
+            return await cache.aembed(client, model, texts, scheduler)
+    return MicroBatcher(handler, **kwargs)
+
+
+def search_batcher(retriever, k, **kwargs):
+    # まとめた質問ベクトルを1回の行列積でscore化する
+    async def handler(vectors):
+        scores, ids = await asyncio.to_thread(retriever.search, np.stack(vectors), k)
+        # 件数が足りないときの埋め草 (id = -1) は取り除く
+        return [(s[i >= 0], i[i >= 0]) for s, i in zip(scores, ids)]
+    return MicroBatcher(handler, **kwargs)
@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+
+from retriever import TOP_K, make_retriever, sample_queries, search, stack_results, uses_embedding
+from store import load_index
+from tokens import count_tokens
+
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", "0.7"))               # 1に近いほど関連度、0に近いほど多様さを重視
+MAX_PER_SOURCE = int(os.getenv("MAX_PER_SOURCE", "2"))           # 同じ作品から選ぶ件数の上限（0なら無制限）
+MMR_CANDIDATES = int(os.getenv("MMR_CANDIDATES", "20"))          # 選び直す前に元の検索から取る件数
+
+
+def mmr(relevance, vectors, k, lambda_=MMR_LAMBDA, groups=None, max_per_group=MAX_PER_SOURCE):
+    """Maximal Marginal Relevance で候補から k 件を選び、選んだ候補の位置を選んだ順に返す
+
+    候補どうしの類似度は最初に1回の行列積で求め、各ステップは候補全体へのベクトル演算だけで済ませる。
+    groups（候補ごとの出典番号）を渡すと、同じ出典からは max_per_group 件までしか選ばない
+    （それだけでは k 件に届かないときは、上限を超えて残りの候補から選ぶ）。
+    """
+    n = len(relevance)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    similarity = vectors @ vectors.T
+    remaining = np.ones(n, dtype=bool)
+    available = remaining.copy()
+    redundancy = np.zeros(n, dtype=np.float32)     # 選んだ候補との類似度の最大値
+    if groups is not None and max_per_group:
+        labels = np.unique(groups, return_inverse=True)[1]
+        group_counts = np.zeros(labels.max() + 1, dtype=np.int64)
+
+    selected = []
+    for _ in range(min(k, n)):
+        if not available.any():
+            available = remaining.copy()
+        scores = np.where(available, lambda_ * relevance - (1 - lambda_) * redundancy, -np.inf)
+        best = int(np.argmax(scores))
+        selected.append(best)
+        remaining[best] = available[best] = False
+        redundancy = similarity[best] if len(selected) == 1 else np.maximum(redundancy, similarity[best])
+
+        if groups is not None and max_per_group:
+            group_counts[labels[best]] += 1
+            if group_counts[labels[best]] >= max_per_group:
+                available &= labels != labels[best]
+    return np.array(selected, dtype=np.int64)
+
+
+class DiversifiedRetriever:
+    """元の検索で多めに取った候補を、MMRと出典ごとの上限で選び直す"""
+
+    def __init__(self, base, index, lambda_=MMR_LAMBDA, max_per_source=MAX_PER_SOURCE, candidates=MMR_CANDIDATES):
+        self.base = base
+        self.embeddings = index.embeddings
+        self.source_ids = index.chunks.source_ids
+        self.lambda_ = lambda_
+        self.max_per_source = max_per_source
+        self.candidates = candidates
+        # 検索に使うものは元の方式に合わせる（ベクトルだけなら、サーバーでまとめて検索できる）
+        self.uses_embedding = uses_embedding(base)
+        self.uses_text = getattr(base, "uses_text", False) or not self.uses_embedding
+
+    def __len__(self):
+        return len(self.base)
+
+    def select(self, query, scores, ids, k):
+        # 1クエリ分の候補 (scores, ids) から k 件を選ぶ
+        keep = ids >= 0
+        scores, ids = scores[keep], ids[keep]
+        vectors = np.asarray(self.embeddings[ids], dtype=np.float32)
+        if query is not None and not self.uses_text:
+            # ベクトル検索ではクエリとのコサイン類似度（近似検索のscoreではなく正確な値）を関連度とする
+            query = query / max(float(np.linalg.norm(query)), 1e-12)
+            relevance = vectors @ query
+        else:
+            # BM25・hybrid（RRF）では、元のscoreを最大1にそろえて関連度とする
+            relevance = scores / scores.max() if len(scores) and scores.max() > 0 else scores
+        order = mmr(relevance, vectors, k, self.lambda_, self.source_ids[ids], self.max_per_source)
+        return relevance[order].astype(np.float32), ids[order]
+
+    def search(self, query_vec, k=TOP_K, query_text=None):
+        n = max(k, self.candidates)
+        scores, ids = search(self.base, query_vec, n, query_text)
+        if query_vec is None or np.ndim(query_vec) == 1:
+            query = None if query_vec is None else np.asarray(query_vec, dtype=np.float32)
+            return self.select(query, np.asarray(scores), np.asarray(ids), k)
+
+        queries = np.asarray(query_vec, dtype=np.float32)
+        results = [self.select(q, s, i, k) for q, s, i in zip(queries, scores, ids)]
+        return stack_results(results, k, single=False)
+
+
+def overlap_chars(chunks, ids):
+    # 選んだチャンクどうしで、同じ作品の同じ範囲を重複して送る文字数（元ファイル上の位置で数える）
+    spans = [(chunks[i]["source"], chunks[i].get("start"), chunks[i].get("end")) for i in ids]
+    total = 0
+    for a in range(len(spans)):
+        for b in range(a + 1, len(spans)):
+            (sa, start_a, end_a), (sb, start_b, end_b) = spans[a], spans[b]
+            if sa == sb and start_a is not None and start_b is not None:
+                total += max(0, min(end_a, end_b) - max(start_a, start_b))
+    return total
+
+
+def describe(index, queries, results, model):
+    # 上位k件の中身: 送るトークン数・重複する文字数・作品の種類・チャンクどうしの類似度・クエリとの類似度
+    tokens, overlaps, sources, redundancy, relevance = [], [], [], [], []
+    for query, ids in zip(queries, results):
+        ids = ids[ids >= 0]
+        vectors = np.asarray(index.embeddings[ids], dtype=np.float32)
+        pairs = vectors @ vectors.T
+        tokens.append(sum(count_tokens(index.chunks[i]["text"], model) for i in ids))
+        overlaps.append(overlap_chars(index.chunks, ids))
+        sources.append(len(set(index.chunks.source_ids[ids].tolist())))
+        if len(ids) > 1:
+            redundancy.append(pairs[np.triu_indices(len(ids), 1)].mean())
+        relevance.append((vectors @ query).mean())
+    return {
+        "context_tokens": float(np.mean(tokens)),
+        "overlap_chars": float(np.mean(overlaps)),
+        "distinct_sources": float(np.mean(sources)),
+        "pairwise_similarity": float(np.mean(redundancy)) if redundancy else None,
+        "query_similarity": float(np.mean(relevance)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="通常の上位k件とMMRで選び直した上位k件を、送るトークン数・重複・レイテンシで比べる")
+    parser.add_argument("index", nargs="?", default=os.getenv("INDEX_DIR", "kenji_index"))
+    parser.add_argument("--mode", default="exact", help="元の検索の方式（ベクトル検索のもの）")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=TOP_K)
+    parser.add_argument("--lambdas", default="1.0,0.7,0.5", help="試すMMRのλ（カンマ区切り）")
+    parser.add_argument("--max-per-source", type=int, default=MAX_PER_SOURCE)
+    parser.add_argument("--candidates", type=int, default=MMR_CANDIDATES)
+    parser.add_argument("--model", default=os.getenv("MODEL_NAME"), help="トークン数を数えるモデル")
+    parser.add_argument("--out", help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    index = load_index(args.index)
+    base = make_retriever(index, args.mode)
+    queries = sample_queries(index.embeddings, args.queries)
+
+    def timed_search(k):
+        results = []
+        start = time.perf_counter()
+        for query in queries:
+            results.append(base.search(query, k))
+        return results, (time.perf_counter() - start) / len(queries) * 1000
+
+    plain, plain_ms = timed_search(args.k)
+    rows = [dict(name="top-k", search_ms=plain_ms, diversify_us=0.0,
+                 **describe(index, queries, [ids for _, ids in plain], args.model))]
+
+    # 候補は1回だけ取り、選び直しにかかる時間だけを別に計る
+    candidates, candidates_ms = timed_search(max(args.k, args.candidates))
+    for lambda_ in (float(x) for x in args.lambdas.split(",")):
+        retriever = DiversifiedRetriever(base, index, lambda_, args.max_per_source, args.candidates)
+        results = []
+        start = time.perf_counter()
+        for query, (scores, ids) in zip(queries, candidates):
+            results.append(retriever.select(query, scores, ids, args.k)[1])
+        select_ms = (time.perf_counter() - start) / len(queries) * 1000
+        rows.append(dict(
+            name=f"mmr λ={lambda_} cap={args.max_per_source}", search_ms=candidates_ms + select_ms,
+            diversify_us=select_ms * 1000, **describe(index, queries, results, args.model)
+        ))
+
+    for row in rows:
+        print(
+            f"{row['name']:<22} {row['context_tokens']:7.1f} tokens  overlap {row['overlap_chars']:6.1f} chars  "
+            f"{row['distinct_sources']:.2f} sources  pairwise sim {row['pairwise_similarity'] or 0:.3f}  "
+            f"query sim {row['query_similarity']:.3f}  search {row['search_ms']:.3f}ms "
+            f"(diversify {row['diversify_us']:.0f}µs)"
+        )
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"index": args.index, "mode": args.mode, "k": args.k, "queries": len(queries), "results": rows},
+                      f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
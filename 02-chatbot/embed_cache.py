@@ -0,0 +1,179 @@
+import os
+import sqlite3
+import asyncio
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+from ratelimit import INTERACTIVE
+from tokens import count_tokens
+
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", "embedding_cache.sqlite3")
+MEMORY_SIZE = int(os.getenv("EMBED_CACHE_MEMORY_SIZE", "10000"))   # メモリ上に置く件数
+BATCH_SIZE = 100          # 1リクエストにまとめる件数の上限（ingest.py と同じ）
+BATCH_TOKENS = 100_000    # 1リクエストにまとめるトークン数の上限（APIの上限より十分小さく）
+
+
+def normalize_text(text):
+    # 全角・半角や前後の空白の違いだけの入力は同じものとして扱う
+    return unicodedata.normalize("NFKC", text).strip()
+
+
+class EmbeddingCache:
+    """(モデル名, 正規化したテキスト) をキーにしたベクトルのキャッシュ
+
+    メモリ上のLRUとSQLiteファイルの2段構成。SQLiteはCLIとStreamlitアプリで共有でき、再起動後も残る。
+    """
+
+    def __init__(self, path=EMBED_CACHE_PATH, memory_size=MEMORY_SIZE):
+        self.path = path
+        self.memory_size = memory_size
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.tokens_saved = 0
+        self.bytes_saved = 0
+
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            # 複数プロセスから同時に読み書きできるようにする
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT NOT NULL, text TEXT NOT NULL, vector BLOB NOT NULL, "
+                "PRIMARY KEY (model, text))"
+            )
+            self._db.commit()
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def get_many(self, model, texts):
+        keys = [(model, normalize_text(t)) for t in texts]
+        vectors = [None] * len(texts)
+        missing = []
+
+        with self._lock:
+            for i, key in enumerate(keys):
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    vectors[i] = self._memory[key]
+                    self.memory_hits += 1
+                else:
+                    missing.append(i)
+
+            if self._db is not None and missing:
+                still_missing = []
+                for i in missing:
+                    row = self._db.execute(
+                        "SELECT vector FROM embeddings WHERE model = ? AND text = ?", keys[i]
+                    ).fetchone()
+                    if row is None:
+                        still_missing.append(i)
+                        continue
+                    vectors[i] = np.frombuffer(row[0], dtype=np.float32)
+                    self._remember(keys[i], vectors[i])
+                    self.disk_hits += 1
+                missing = still_missing
+
+            self.misses += len(missing)
+            for i, vector in enumerate(vectors):
+                if vector is not None:
+                    self.tokens_saved += count_tokens(texts[i])
+                    self.bytes_saved += vector.nbytes
+
+        return vectors
+
+    def put_many(self, model, texts, vectors):
+        rows = []
+        with self._lock:
+            for text, vector in zip(texts, vectors):
+                key = (model, normalize_text(text))
+                vector = np.asarray(vector, dtype=np.float32)
+                self._remember(key, vector)
+                rows.append((*key, vector.tobytes()))
+
+            if self._db is not None:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO embeddings (model, text, vector) VALUES (?, ?, ?)", rows
+                )
+                self._db.commit()
+
+    def _requests(self, texts, missing):
+        # キャッシュになかったものを、1リクエストの件数とトークン数の上限までずつに分ける
+        batch, tokens = [], 0
+        for i in missing:
+            n = count_tokens(texts[i])
+            if batch and (len(batch) >= BATCH_SIZE or tokens + n > BATCH_TOKENS):
+                yield batch, tokens
+                batch, tokens = [], 0
+            batch.append(i)
+            tokens += n
+        if batch:
+            yield batch, tokens
+
+    def _store(self, model, texts, vectors, batch, res):
+        new = [d.embedding for d in sorted(res.data, key=lambda d: d.index)]
+        self.put_many(model, [texts[i] for i in batch], new)
+        for i, vector in zip(batch, new):
+            vectors[i] = np.asarray(vector, dtype=np.float32)
+
+    def embed(self, client, model, texts, scheduler=None, priority=INTERACTIVE):
+        # キャッシュにないものだけをベクトル化する（多い場合は上限ごとに分けてリクエストする）
+        vectors = self.get_many(model, texts)
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        for batch, tokens in self._requests(texts, missing):
+            inputs = [texts[i] for i in batch]
+            create = lambda: client.embeddings.create(model=model, input=inputs)
+            if scheduler is None:
+                res = create()
+            else:
+                res = scheduler.embeddings.call(
+                    create, tokens, priority, usage_tokens=lambda r: r.usage.total_tokens,
+                )
+            self._store(model, texts, vectors, batch, res)
+        return vectors
+
+    async def aembed(self, client, model, texts, scheduler=None, priority=INTERACTIVE):
+        # embed() の AsyncOpenAI 版（SQLiteの読み書きはイベントループを止めないよう別スレッドで行う）
+        vectors = await asyncio.to_thread(self.get_many, model, texts)
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        for batch, tokens in self._requests(texts, missing):
+            inputs = [texts[i] for i in batch]
+            create = lambda: client.embeddings.create(model=model, input=inputs)
+            if scheduler is None:
+                res = await create()
+            else:
+                res = await scheduler.embeddings.acall(
+                    create, tokens, priority, usage_tokens=lambda r: r.usage.total_tokens,
+                )
+            await asyncio.to_thread(self._store, model, texts, vectors, batch, res)
+        return vectors
+
+    def stats(self):
+        hits = self.memory_hits + self.disk_hits
+        total = hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": hits / total if total else 0.0,
+            "tokens_saved": self.tokens_saved,
+            "bytes_saved": self.bytes_saved,
+        }
+
+
+def format_embed_stats(stats):
+    return (
+        f"embedding cache | hits: {stats['memory_hits']} memory + {stats['disk_hits']} disk, "
+        f"misses: {stats['misses']}, hit rate: {stats['hit_rate']:.1%}, "
+        f"saved: {stats['tokens_saved']} tokens / {stats['bytes_saved'] / 1024:.1f} KiB"
+    )
@@ -0,0 +1,227 @@
+import os
+import asyncio
+
+from answer_cache import context_key
+from dispatcher import embedding_batcher, search_batcher
+from gate import RETRIEVE, REUSE
+from llm import AsyncChatStream, ChatStream
+from prompt import CONTEXT_REFILL, HISTORY_LIMIT, SYSTEM_PROMPT, build_prompt, is_context
+from retriever import TOP_K, search, traced_search, uses_embedding
+
+MAX_UPSTREAM = int(os.getenv("MAX_UPSTREAM", "16"))   # サーバーで同時に投げる上流リクエスト数
+
+
+class Conversation:
+    """1つの会話の状態: 履歴と、直前に検索した参考文章の番号"""
+
+    def __init__(self):
+        self.history = []
+        self.last_chunk_ids = None
+
+    def forget_context(self):
+        # インデックスを読み込み直したら、古いインデックスの文章番号と履歴に残した参考文章は使えない
+        self.last_chunk_ids = None
+        self.history = [m for m in self.history if not is_context(m)]
+
+
+class Turn:
+    """1ターン分の途中経過"""
+
+    def __init__(self, conversation, user_input, trace):
+        self.conversation = conversation
+        self.user_input = user_input
+        self.trace = trace
+        self.key = context_key(conversation.history)
+        self.decision = None
+        self.query_embedding = None
+        self.cached = None
+        self.chunk_ids = []
+        self.messages = None
+        self.plan = None
+        self.context = None
+        self.reply = None
+        self.usage = None
+
+
+class ChatEngine:
+    """1ターンの処理: 検索するかの判定 → embedding → 回答キャッシュ → 検索 → プロンプト組み立て → 生成 → 履歴
+
+    CLI（chat_bot.py）・Streamlit（app.py）・HTTPサーバー（server.py）で共通に使う。
+    reply() は ("delta", 生成された文字列) を順に返し、最後に ("done", 結果) を返すジェネレータ。
+    入出力のない手順は _ で始まるメソッドにまとめ、同期版と asyncio 版（AsyncChatEngine）で共有する。
+    """
+
+    def __init__(self, client, chunks, retriever, model, embedding_model, answer_cache, embed_cache, gate,
+                 metrics, scheduler, top_k=TOP_K, system_prompt=SYSTEM_PROMPT):
+        self.client = client
+        self.chunks = chunks
+        self.retriever = retriever
+        self.model = model
+        self.embedding_model = embedding_model
+        self.answer_cache = answer_cache
+        self.embed_cache = embed_cache
+        self.gate = gate
+        self.metrics = metrics
+        self.scheduler = scheduler
+        self.top_k = top_k
+        self.system_prompt = system_prompt
+        # 直近のターンで送った文章と重なったときの埋め合わせに、CONTEXT_REFILL件多く取っておく
+        self.n_candidates = top_k + CONTEXT_REFILL
+
+    def _decided(self, turn, decision):
+        turn.decision = decision
+        turn.trace.count(f"gate_{decision['action']}")
+
+    def _needs_embedding(self, turn):
+        # bm25モードではembeddingを取らない（回答キャッシュも使わない）
+        return turn.decision["action"] == RETRIEVE and uses_embedding(self.retriever)
+
+    def _lookup(self, turn):
+        # 同じ文脈で似た質問に答えたことがあれば、検索も生成もせずにその回答を返す
+        turn.cached = self.answer_cache.lookup(turn.query_embedding, turn.key)
+        if turn.cached is not None:
+            turn.trace.count("answer_cache_hits")
+            turn.reply = turn.cached["answer"]
+            turn.chunk_ids = turn.cached["chunk_ids"]
+            # 続きを求める質問には、保存済みの回答を作ったときの参考文章を使う
+            turn.conversation.last_chunk_ids = turn.chunk_ids
+
+    def _retrieved(self, turn, ids):
+        turn.chunk_ids = ids
+        turn.conversation.last_chunk_ids = ids
+
+    def _assemble(self, turn):
+        if turn.decision["action"] == REUSE:
+            turn.chunk_ids = turn.conversation.last_chunk_ids
+        retrieved = [self.chunks[i] for i in turn.chunk_ids]
+        turn.sources = [c["source"] for c in retrieved]
+
+        # トークン予算内で システムプロンプト → 参考文章 → 直近の履歴 の順に詰める
+        # 履歴に残っている前のターンの参考文章にある文章は送り直さず、空いた枠を次の候補で埋める
+        with turn.trace.stage("prompt_assembly"):
+            turn.messages, turn.plan, turn.context = build_prompt(
+                self.system_prompt, [c["text"] for c in retrieved], turn.conversation.history, turn.user_input,
+                model=self.model, context_ids=turn.chunk_ids, k=self.top_k,
+            )
+        turn.trace.count("context_chunks_deduped", turn.plan["deduped_chunks"])
+
+    def _generated(self, turn, stream):
+        turn.reply = stream.text
+        turn.usage = stream.usage
+        turn.trace.add_usage(stream.usage)
+        if turn.query_embedding is not None:
+            self.answer_cache.store(turn.query_embedding, turn.reply, turn.chunk_ids, turn.key)
+
+    def _finish(self, turn):
+        history = turn.conversation.history
+        if turn.context is not None:
+            history.append(turn.context)
+        history.append({"role": "user", "content": turn.user_input})
+        history.append({"role": "assistant", "content": turn.reply})
+        del history[:-HISTORY_LIMIT]
+
+        if turn.cached is not None:
+            return {
+                "cached": True,
+                "similarity": turn.cached["similarity"],
+                "chunk_ids": turn.chunk_ids,
+                "answer": turn.reply,
+            }
+        return {
+            "cached": False,
+            "chunk_ids": [int(i) for i in turn.chunk_ids],
+            "sources": turn.sources,
+            "usage": turn.usage,
+            "plan": turn.plan,
+            "gate": turn.decision,
+            "answer": turn.reply,
+        }
+
+    def reply(self, conversation, user_input):
+        turn = Turn(conversation, user_input, self.metrics.turn())
+        self._decided(turn, self.gate.decide(user_input, conversation.history, conversation.last_chunk_ids))
+
+        if self._needs_embedding(turn):
+            with turn.trace.stage("query_embedding"):
+                turn.query_embedding = self.embed_cache.embed(
+                    self.client, self.embedding_model, [user_input], self.scheduler
+                )[0]
+            self._lookup(turn)
+
+        if turn.cached is not None:
+            yield "delta", turn.reply
+        else:
+            if turn.decision["action"] == RETRIEVE:
+                # コサイン類似度（またはBM25）でscore化し、上位の文章を選ぶ
+                _, ids = traced_search(self.retriever, turn.query_embedding, self.n_candidates, turn.trace, user_input)
+                self._retrieved(turn, ids)
+            self._assemble(turn)
+
+            # 生成された分から順に返す（最初のトークンまでの時間と生成全体の時間を計る）
+            stream = ChatStream(self.client, self.model, turn.messages, self.scheduler)
+            with turn.trace.stage("llm_completion"):
+                for delta in stream:
+                    turn.trace.mark_once("llm_first_token", since="llm_completion")
+                    yield "delta", delta
+            self._generated(turn, stream)
+
+        result = self._finish(turn)
+        turn.trace.finish()
+        yield "done", result
+
+
+class AsyncChatEngine(ChatEngine):
+    """ChatEngine の asyncio 版（server.py 用）
+
+    同時に届いた質問のembeddingと検索はまとめて行い、同時に投げる上流リクエストは max_upstream までにする。
+    ファイルやSQLiteへの読み書き（判定の記録・メトリクス・embeddingキャッシュ）と検索はイベントループの外で行う。
+    """
+
+    def __init__(self, *args, max_upstream=MAX_UPSTREAM, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 同時実行数はユーザー数ではなく上流の枠（同時接続数とRPM/TPM）で決める
+        self.upstream = asyncio.Semaphore(max_upstream)
+        self.embed_batcher = embedding_batcher(
+            self.client, self.embedding_model, self.embed_cache, self.upstream, self.scheduler
+        )
+        self.search_batcher = search_batcher(self.retriever, self.n_candidates)
+
+    async def _search(self, query_embedding, user_input):
+        # クエリのテキストも使う方式（bm25・hybrid）はまとめずに1件ずつ検索する
+        if uses_embedding(self.retriever) and not getattr(self.retriever, "uses_text", False):
+            return await self.search_batcher.submit(query_embedding)
+        return await asyncio.to_thread(search, self.retriever, query_embedding, self.n_candidates, user_input)
+
+    async def areply(self, conversation, user_input):
+        turn = Turn(conversation, user_input, self.metrics.turn())
+        decision = await asyncio.to_thread(
+            self.gate.decide, user_input, conversation.history, conversation.last_chunk_ids
+        )
+        self._decided(turn, decision)
+
+        if self._needs_embedding(turn):
+            with turn.trace.stage("query_embedding"):
+                turn.query_embedding = await self.embed_batcher.submit(user_input)
+            self._lookup(turn)
+
+        if turn.cached is not None:
+            yield "delta", turn.reply
+        else:
+            if turn.decision["action"] == RETRIEVE:
+                # まとめて検索するので、上位k件の選択も含めて scoring として計る
+                with turn.trace.stage("scoring"):
+                    _, ids = await self._search(turn.query_embedding, user_input)
+                self._retrieved(turn, ids)
+            self._assemble(turn)
+
+            stream = AsyncChatStream(self.client, self.model, turn.messages, self.scheduler)
+            async with self.upstream:
+                with turn.trace.stage("llm_completion"):
+                    async for delta in stream:
+                        turn.trace.mark_once("llm_first_token", since="llm_completion")
+                        yield "delta", delta
+            self._generated(turn, stream)
+
+        result = self._finish(turn)
+        await asyncio.to_thread(turn.trace.finish)
+        yield "done", result
@@ -0,0 +1,117 @@
+import os
+import re
+import json
+import time
+import threading
+import unicodedata
+
+from lexical import ngrams
+
+GATE_ENABLED = os.getenv("RETRIEVAL_GATE", "1") != "0"    # 0 なら毎ターン検索する
+GATE_LOG = os.getenv("GATE_LOG", "gate_decisions.jsonl")   # 判定の記録（空なら出力しない）
+
+FOLLOW_UP_MAX_CHARS = 20   # これより長い入力は追加の質問とみなさない
+SKIP_MAX_CHARS = 12        # あいさつ・相づちとみなす長さの上限
+REUSE_OVERLAP = 0.6        # 直前のやりとりと共通する内容語の割合がこれ以上なら前回の参考文章を使う
+
+RETRIEVE = "retrieve"
+REUSE = "reuse"
+SKIP = "skip"
+
+# 検索しても意味のない、あいさつ・お礼・相づち
+SKIP_PHRASES = {
+    "こんにちは", "こんばんは", "おはよう", "おはようございます", "はじめまして", "よろしく", "よろしくおねがいします",
+    "ありがとう", "ありがとうございます", "ありがとうございました", "どうも", "どうもありがとう",
+    "はい", "いいえ", "うん", "ええ", "そう", "そうですか", "そうなんだ", "そうなんですね", "なるほど",
+    "わかりました", "了解", "すごい", "いいね", "おやすみ", "おやすみなさい", "またね",
+}
+SKIP_PREFIXES = ("ありがとう", "こんにちは", "こんばんは", "おはよう")
+
+# 前のターンの続きを求める言い回し（前回の参考文章で答えられる）
+FOLLOW_UP_MARKERS = (
+    "もっと", "詳しく", "くわしく", "続き", "つづき", "さらに", "他には", "ほかには",
+    "それは", "それって", "それで", "その後", "そのあと", "具体的", "例えば", "たとえば", "どういう意味",
+)
+
+FOLLOW_UP_PATTERN = re.compile("|".join(map(re.escape, FOLLOW_UP_MARKERS)))
+
+PUNCTUATION = re.compile(r"[\W_ー〜～]+")
+CONTENT_CHAR = re.compile(r"[一-鿿ァ-ヺA-Za-z0-9]")    # 漢字・カタカナ（長音記号を除く）・英数字
+
+
+def normalize(text):
+    return PUNCTUATION.sub("", unicodedata.normalize("NFKC", text))
+
+
+def content_grams(text):
+    # 漢字・カタカナ・英数字を含む文字bigram（ひらがなだけの機能語は除く）
+    return {g for g in ngrams(unicodedata.normalize("NFKC", text), (2,)) if CONTENT_CHAR.search(g)}
+
+
+class RetrievalGate:
+    """ターンごとに、新しく検索する・前回の参考文章を使う・参考文章なし のどれにするかを決める"""
+
+    def __init__(self, enabled=GATE_ENABLED, log_path=GATE_LOG):
+        self.enabled = enabled
+        self.log_path = log_path
+        self.counts = {RETRIEVE: 0, REUSE: 0, SKIP: 0}
+        self._lock = threading.Lock()
+
+    def classify(self, user_input, history, last_ids):
+        # (判定, 理由) を返す。ルール → 直前のやりとりとの語の重なり の順に見る
+        if not self.enabled:
+            return RETRIEVE, "disabled"
+
+        text = normalize(user_input)
+        has_context = last_ids is not None and len(last_ids) > 0
+
+        if not text:
+            return SKIP, "empty"
+        if text in SKIP_PHRASES or (len(text) <= SKIP_MAX_CHARS and text.startswith(SKIP_PREFIXES)):
+            return SKIP, "greeting"
+
+        grams = content_grams(user_input)
+        if not has_context:
+            return RETRIEVE, "new topic"
+        previous = content_grams(" ".join(m["content"] for m in history[-2:])) if history else set()
+
+        # 「どうして？」「それから？」のように内容語のない短い入力は、直前の答えへの問いとみなす
+        if not grams:
+            return REUSE, "no content words"
+        # 続きを求める言い回しがあっても、それ以外の部分が新しい語を持ち込むなら新しい話題として検索する
+        if len(text) <= FOLLOW_UP_MAX_CHARS and any(m in text for m in FOLLOW_UP_MARKERS):
+            rest = content_grams(FOLLOW_UP_PATTERN.sub(" ", unicodedata.normalize("NFKC", user_input)))
+            if not rest - previous:
+                return REUSE, "follow-up"
+
+        overlap = len(grams & previous) / len(grams)
+        if overlap >= REUSE_OVERLAP:
+            return REUSE, f"same topic ({overlap:.2f})"
+
+        return RETRIEVE, "new topic"
+
+    def decide(self, user_input, history, last_ids):
+        action, reason = self.classify(user_input, history, last_ids)
+        with self._lock:
+            self.counts[action] += 1
+            if self.log_path:
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({
+                        "time": time.time(),
+                        "input": user_input,
+                        "action": action,
+                        "reason": reason,
+                    }, ensure_ascii=False) + "\n")
+        return {"action": action, "reason": reason}
+
+    def stats(self):
+        return dict(self.counts)
+
+
+def format_gate_stats(stats):
+    total = sum(stats.values())
+    skipped = stats[REUSE] + stats[SKIP]
+    return (
+        f"retrieval gate | retrieve: {stats[RETRIEVE]}, reuse: {stats[REUSE]}, skip: {stats[SKIP]}, "
+        f"no search: {skipped / total:.1%}" if total else "retrieval gate | no turns yet"
+    )
@@ -0,0 +1,397 @@
+import os
+import json
+import hashlib
+import contextlib
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from dotenv import load_dotenv
+from openai import OpenAI
+
+from ann import DRIFT_MIN_ROWS, DRIFT_TOLERANCE, IVF_META_FILE, RETRAIN_FRACTION, IVFIndex
+from corpus import TEXT_DIR, CHUNK_TOKENS, CHUNK_OVERLAP, NORMALIZER_VERSION
+from embed_cache import EmbeddingCache, format_embed_stats
+from lexical import BM25Index
+from pq import PQ_META_FILE, PQIndex
+from preprocess import WORKERS, iter_processed
+from quant import SQ_META_FILE, SQ_MODES, ScalarQuantizedIndex
+from ratelimit import BULK, format_scheduler_stats, get_scheduler
+from store import META_FILE, IndexWriter, atomic_open, load_index
+from tokens import count_tokens
+
+load_dotenv()
+
+API_KEY = os.getenv("OPENAI_API_KEY")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL")
+
+INDEX_DIR = os.getenv("INDEX_DIR", "kenji_index")
+CHECKPOINT_FILE = "ingest_checkpoint.jsonl"
+MANIFEST_FILE = "manifest.json"
+
+BATCH_SIZE = 100      # 1リクエストにまとめるチャンク数
+CONCURRENCY = 4       # 同時に投げるリクエスト数の上限
+MAX_RETRIES = 8
+
+def text_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def embed_batch(client, texts, model=EMBEDDING_MODEL, scheduler=None, max_retries=MAX_RETRIES):
+    # 枠の取得とリトライはスケジューラが行う（対話中のターンより後回しにする）
+    scheduler = scheduler or get_scheduler()
+    res = scheduler.embeddings.call(
+        lambda: client.embeddings.create(model=model, input=texts),
+        estimate=sum(count_tokens(t) for t in texts),
+        priority=BULK,
+        usage_tokens=lambda r: r.usage.total_tokens,
+        max_retries=max_retries,
+    )
+    # 返却順は保証されないので index で並べ直す
+    return [d.embedding for d in sorted(res.data, key=lambda d: d.index)]
+
+
+class Checkpoint:
+    """ベクトル化の途中経過（JSONL）。ベクトルは読み込まず、ハッシュごとの行の位置だけを持ち、
+    必要になったバッチの分だけ読み返す
+    """
+
+    def __init__(self, path, model=EMBEDDING_MODEL):
+        self.model = model
+        self.positions = {}
+        self.file = open(path, "a+b")
+        self.file.seek(0)
+        position = 0
+        for line in self.file:
+            if not line.endswith(b"\n"):
+                # 書き込み途中で落ちた最終行は捨てる（続けて追記すると行が壊れるので切り詰める）
+                self.file.truncate(position)
+                break
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                record = {}
+            # 別のモデルで作ったベクトル（モデル名のない古い形式を含む）は使わない
+            if record.get("model") == model:
+                self.positions[record["hash"]] = position
+            position += len(line)
+
+    def __contains__(self, h):
+        return h in self.positions
+
+    def get(self, h):
+        self.file.flush()
+        self.file.seek(self.positions[h])
+        return json.loads(self.file.readline())["embedding"]
+
+    def add(self, h, embedding):
+        self.file.seek(0, os.SEEK_END)
+        self.positions[h] = self.file.tell()
+        self.file.write((json.dumps({"hash": h, "model": self.model, "embedding": embedding}) + "\n").encode("utf-8"))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def embed_rows(client, hashes, text_of, write, checkpoint_path, model=EMBEDDING_MODEL,
+               batch_size=BATCH_SIZE, concurrency=CONCURRENCY, reuse=None, cache=None):
+    """行ごとのベクトルを batch_size 行ずつ求め、write(rows, vectors) で書き込む
+
+    hashes: 行ごとのテキストのハッシュ。text_of(row): 行の本文
+    reuse(rows): 前回のインデックスから引き継げる行を (引き継げるかのマスク, ベクトル) で返す
+    cache: チャットと共有している EmbeddingCache
+    前回のインデックス → チェックポイント → キャッシュ → API の順に探す。APIに投げて結果を待っている
+    バッチは concurrency * 2 件までにするので、メモリに載るのはその分のテキストとベクトルだけになる。
+    """
+    counts = {"reused": 0, "checkpoint": 0, "cache": 0, "embedded": 0, "requests": 0}
+    inflight = {}     # APIに投げたテキストのハッシュ → 結果を書き込む行
+    pending = deque()
+
+    def finish(batch, texts, future):
+        embeddings = future.result()
+        for h, embedding in zip(batch, embeddings):
+            rows = inflight.pop(h)
+            write(rows, [embedding] * len(rows))
+            checkpoint.add(h, embedding)
+        if cache is not None:
+            cache.put_many(model, texts, embeddings)
+        # バッチごとにディスクへ書き出し、再実行時はここから再開する
+        checkpoint.flush()
+        counts["embedded"] += len(batch)
+        print(f"[{counts['embedded']} embedded] {len(batch)} chunks")
+
+    with contextlib.closing(Checkpoint(checkpoint_path, model)) as checkpoint, \
+            ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for start in range(0, len(hashes), batch_size):
+            rows = np.arange(start, min(start + batch_size, len(hashes)))
+            if reuse is not None:
+                found, vectors = reuse(rows)
+                if found.any():
+                    write(rows[found], vectors)
+                    counts["reused"] += int(found.sum())
+                rows = rows[~found]
+
+            todo = {}
+            for row in rows.tolist():
+                h = hashes[row]
+                if h in inflight:
+                    inflight[h].append(row)
+                elif h in checkpoint:
+                    write([row], [checkpoint.get(h)])
+                    counts["checkpoint"] += 1
+                else:
+                    todo.setdefault(h, []).append(row)
+
+            if cache is not None and todo:
+                cached = cache.get_many(model, [text_of(r[0]) for r in todo.values()])
+                for (h, r), vector in zip(list(todo.items()), cached):
+                    if vector is not None:
+                        write(r, [vector] * len(r))
+                        counts["cache"] += 1
+                        del todo[h]
+
+            if todo:
+                inflight.update(todo)
+                batch = list(todo)
+                texts = [text_of(todo[h][0]) for h in batch]
+                pending.append((batch, texts, executor.submit(embed_batch, client, texts, model)))
+                counts["requests"] += 1
+            while len(pending) >= concurrency * 2:
+                finish(*pending.popleft())
+        while pending:
+            finish(*pending.popleft())
+
+    print(f"{len(hashes)} chunks: {counts['reused']} reused from the index, {counts['checkpoint']} from the checkpoint, "
+          f"{counts['cache']} from the cache, {counts['embedded']} embedded in {counts['requests']} requests")
+    return counts
+
+
+def embed_chunks(client, chunks, checkpoint_path, model=EMBEDDING_MODEL,
+                 batch_size=BATCH_SIZE, concurrency=CONCURRENCY, cache=None):
+    # メモリに載る大きさのチャンクの一覧をベクトル化して、チャンクと同じ順のリストで返す（ノートブック用）
+    vectors = [None] * len(chunks)
+
+    def write(rows, embeddings):
+        for row, embedding in zip(rows, embeddings):
+            vectors[row] = np.asarray(embedding, dtype=float).tolist()
+
+    embed_rows(
+        client, [text_hash(c["text"]) for c in chunks], lambda row: chunks[row]["text"], write,
+        checkpoint_path, model=model, batch_size=batch_size, concurrency=concurrency, cache=cache,
+    )
+    return vectors
+
+
+def load_manifest(path):
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    if not os.path.exists(manifest_path) or not os.path.exists(os.path.join(path, META_FILE)):
+        return None
+    with open(manifest_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def plan_chunks(text_dir, chunking, manifest, previous, writer, workers=WORKERS):
+    # 前処理・分割したチャンクをファイルごとにそのまま writer に書き出す（チャンクの一覧はメモリに持たない）
+    # ファイルのハッシュが前回と同じなら、前回のチャンクをそのまま使う（前処理・分割を省略）
+    # 変わったファイルの前処理・分割は複数プロセスで並列に行う
+    prev_files = manifest["files"] if manifest else {}
+    prev_rows = {}
+    if previous is not None:
+        # 出典ごとの行番号（出典番号で1回並べ替えて区切る）
+        source_ids = np.asarray(previous.chunks.source_ids)
+        order = np.argsort(source_ids, kind="stable")
+        bounds = np.searchsorted(source_ids[order], np.arange(len(previous.chunks.sources) + 1))
+        for source_id, source in enumerate(previous.chunks.sources):
+            prev_rows[source] = order[bounds[source_id]:bounds[source_id + 1]]
+
+    files = {}
+    status = {"unchanged": [], "changed": [], "added": []}
+
+    known_hashes = {name: f["hash"] for name, f in prev_files.items() if name in prev_rows}
+    items = iter_processed(
+        text_dir, chunking["chunk_tokens"], chunking["overlap"], EMBEDDING_MODEL, workers, known_hashes
+    )
+    for item in items:
+        name = item["filename"]
+        prev = prev_files.get(name)
+
+        if item["chunks"] is None:
+            file_chunks = (previous.chunks[row] for row in prev_rows[name])
+            status["unchanged"].append(name)
+        else:
+            file_chunks = item["chunks"]
+            status["changed" if prev is not None else "added"].append(name)
+
+        hashes = []
+        for chunk in file_chunks:
+            writer.add(chunk)
+            hashes.append(text_hash(chunk["text"]))
+        files[name] = {"hash": item["hash"], "chunks": hashes}
+
+    status["deleted"] = sorted(set(prev_files) - set(files))
+    return files, status
+
+
+def row_hashes(files):
+    # マニフェストのチャンクハッシュはインデックスの行と同じ順番で並んでいる
+    return [h for f in files.values() for h in f["chunks"]]
+
+
+def previous_rows(manifest, previous, hashes):
+    # 新しい行ごとに、同じテキストだった前回の行番号（なければ -1）
+    previous_hashes = row_hashes(manifest["files"]) if manifest else []
+    if previous is None or len(previous_hashes) != len(previous):
+        return np.full(len(hashes), -1, dtype=np.int64)
+    row_of = {h: row for row, h in enumerate(previous_hashes)}
+    return np.array([row_of.get(h, -1) for h in hashes], dtype=np.int64)
+
+
+def load_previous(loader, previous):
+    # 前回のインデックスに合わせて作られた補助インデックス（なければ・古ければ None）
+    if previous is None:
+        return None
+    try:
+        return loader(previous)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def refresh_ivf(embeddings, n_lists, previous_ivf, old_rows):
+    # 前回の中心を使って変わった行だけ割り当てる。引き継げない行が多いか、ずれが大きければ学習し直す
+    # （ずれは新しい行の平均なので、新しい行が DRIFT_MIN_ROWS 行以上あるときだけ見る）
+    reason = None
+    if previous_ivf is None or previous_ivf.quality is None or previous_ivf.n_lists != n_lists:
+        reason = "no reusable IVF"
+    elif np.mean(old_rows < 0) > RETRAIN_FRACTION:
+        reason = f"more than {RETRAIN_FRACTION:.0%} of rows changed"
+    else:
+        ivf, drift = IVFIndex.update(previous_ivf, embeddings, old_rows)
+        n_new = int(np.sum(old_rows < 0))
+        if n_new < DRIFT_MIN_ROWS or drift <= DRIFT_TOLERANCE:
+            tested = "" if n_new >= DRIFT_MIN_ROWS else f", not tested below {DRIFT_MIN_ROWS} rows"
+            print(f"IVF: {ivf.n_lists} lists, assigned {n_new} new rows (drift {drift:.1%}{tested})")
+            return ivf
+        reason = f"drift {drift:.1%}"
+
+    ivf = IVFIndex.build(embeddings, n_lists)
+    print(f"IVF: {ivf.n_lists} lists, retrained ({reason})")
+    return ivf
+
+
+def refresh_pq(embeddings, n_subspaces, previous_pq, old_rows):
+    # 前回の代表ベクトルで変わった行だけ符号化する。引き継げない行が多いか、誤差が増えていれば学習し直す
+    # （IVFと同じく、誤差は新しい行が DRIFT_MIN_ROWS 行以上あるときだけ見る）
+    reason = None
+    if previous_pq is None or previous_pq.error is None or previous_pq.n_subspaces != n_subspaces:
+        reason = "no reusable PQ"
+    elif np.mean(old_rows < 0) > RETRAIN_FRACTION:
+        reason = f"more than {RETRAIN_FRACTION:.0%} of rows changed"
+    else:
+        pq, drift = PQIndex.update(previous_pq, embeddings, old_rows)
+        n_new = int(np.sum(old_rows < 0))
+        if n_new < DRIFT_MIN_ROWS or drift <= DRIFT_TOLERANCE:
+            tested = "" if n_new >= DRIFT_MIN_ROWS else f", not tested below {DRIFT_MIN_ROWS} rows"
+            print(f"PQ: {pq.n_subspaces} subspaces, encoded {n_new} new rows (drift {drift:.1%}{tested})")
+            return pq
+        reason = f"drift {drift:.1%}"
+
+    pq = PQIndex.build(embeddings, n_subspaces)
+    print(f"PQ: {pq.n_subspaces} subspaces, retrained ({reason})")
+    return pq
+
+
+def main():
+    parser = argparse.ArgumentParser(description="コーパスをチャンク化・ベクトル化してインデックスを作る")
+    parser.add_argument("--src", default=TEXT_DIR)
+    parser.add_argument("--out", default=INDEX_DIR)
+    parser.add_argument("--chunk-tokens", type=int, default=CHUNK_TOKENS, help="1チャンクのトークン数の上限")
+    parser.add_argument("--overlap", type=int, default=CHUNK_OVERLAP, help="前のチャンクと重ねるトークン数")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--dtype", choices=("float32", "float16"), default="float32")
+    parser.add_argument("--full", action="store_true", help="差分を使わずに全件作り直す")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="前処理・チャンク分割のプロセス数")
+    parser.add_argument("--ivf-lists", type=int, default=None,
+                        help="IVFインデックスのリスト数（既にIVFがある場合は同じリスト数で作り直す）")
+    args = parser.parse_args()
+
+    # リトライは embed_batch 側で行う
+    client = OpenAI(api_key=API_KEY, max_retries=0)
+
+    chunking = {"chunk_tokens": args.chunk_tokens, "overlap": args.overlap, "normalizer": NORMALIZER_VERSION}
+
+    # モデルかチャンク分割の設定が変わった場合は全件作り直す
+    manifest = None if args.full else load_manifest(args.out)
+    if manifest and (manifest["model"] != EMBEDDING_MODEL or manifest["chunking"] != chunking):
+        print("model or chunking changed: full rebuild")
+        manifest = None
+    previous = load_index(args.out) if manifest else None
+    # 補助インデックスは前回の行番号で引き継ぐので、インデックスを書き換える前に読んでおく
+    previous_ivf = load_previous(IVFIndex.load, previous)
+    previous_pq = load_previous(PQIndex.load, previous)
+
+    writer = IndexWriter(args.out, args.dtype)
+    files, status = plan_chunks(args.src, chunking, manifest, previous, writer, args.workers)
+    print(", ".join(f"{k}: {len(v)} files" for k, v in status.items()))
+
+    checkpoint_path = os.path.join(args.out, CHECKPOINT_FILE)
+    hashes = row_hashes(files)
+    old_rows = previous_rows(manifest, previous, hashes)
+
+    def reuse(rows):
+        # 前回と同じテキストの行は、前回のインデックスのベクトルをそのまま使う
+        found = old_rows[rows] >= 0
+        return found, np.asarray(previous.embeddings[old_rows[rows][found]], dtype=np.float32)
+
+    # メモリ上のLRUはこのプロセスでは使い回さないので、SQLiteだけを使う
+    cache = EmbeddingCache(memory_size=0)
+    embed_rows(
+        client, hashes, writer.text, writer.write_embeddings, checkpoint_path, model=EMBEDDING_MODEL,
+        batch_size=args.batch_size, concurrency=args.concurrency,
+        reuse=reuse if previous is not None else None, cache=cache,
+    )
+    print(format_embed_stats(cache.stats()))
+    print(format_scheduler_stats(get_scheduler().stats()))
+    writer.close(meta={"model": EMBEDDING_MODEL})
+
+    with atomic_open(os.path.join(args.out, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump({
+            "model": EMBEDDING_MODEL,
+            "chunking": chunking,
+            "files": files,
+        }, f, ensure_ascii=False)
+
+    # BM25の転置インデックスはembeddingなしで検索できるよう毎回作る（本文は書き出したインデックスから読む）
+    index = load_index(args.out)
+    bm25 = BM25Index.build(c["text"] for c in index.chunks)
+    bm25.save(args.out)
+    print(f"BM25: {len(bm25.vocab)} terms, {len(bm25.docs)} postings")
+
+    # IVF・量子化・PQインデックスを使っている場合は、変わった行の分を更新する（--full なら作り直す）
+    ivf_lists = args.ivf_lists
+    ivf_meta_path = os.path.join(args.out, IVF_META_FILE)
+    if ivf_lists is None and os.path.exists(ivf_meta_path):
+        with open(ivf_meta_path, encoding="utf-8") as f:
+            ivf_lists = json.load(f)["n_lists"]
+    if ivf_lists:
+        refresh_ivf(index.embeddings, ivf_lists, previous_ivf, old_rows).save(args.out)
+    for mode in SQ_MODES:
+        if os.path.exists(os.path.join(args.out, SQ_META_FILE.format(mode=mode))):
+            ScalarQuantizedIndex.build(index.embeddings, mode).save(args.out)
+            print(f"SQ: {mode}")
+    if os.path.exists(os.path.join(args.out, PQ_META_FILE)):
+        with open(os.path.join(args.out, PQ_META_FILE), encoding="utf-8") as f:
+            n_subspaces = json.load(f)["n_subspaces"]
+        refresh_pq(index.embeddings, n_subspaces, previous_pq, old_rows).save(args.out)
+
+    # インデックスを書き終えたらチェックポイントは不要
+    os.remove(checkpoint_path)
+    print(f"{len(index)} chunks -> {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+import os
+import re
+import json
+import time
+import argparse
+from array import array
+from collections import Counter
+
+import numpy as np
+
+from retriever import TOP_K, top_k
+from store import atomic_open, load_index
+
+# インデックスディレクトリに embeddings.npy と並べて保存する
+BM25_META_FILE = "bm25.json"
+BM25_VOCAB_FILE = "bm25_vocab.json"        # 語（文字n-gram）の一覧。位置が語の番号
+BM25_OFFSETS_FILE = "bm25_offsets.npy"     # 各語のポスティングの開始位置 (V + 1,)
+BM25_DOCS_FILE = "bm25_docs.npy"           # 語の順に並べたチャンク番号 (P,) uint32
+BM25_TF_FILE = "bm25_tf.npy"               # 出現回数 (P,) uint16
+BM25_LENGTHS_FILE = "bm25_lengths.npy"     # チャンクごとの語数 (N,)
+
+NGRAM_SIZES = (2, 3)   # 分かち書きしない日本語向けに文字bigram・trigramを語とする
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+RRF_K = int(os.getenv("RRF_K", "60"))                                  # Reciprocal Rank Fusion の定数
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "50"))          # 統合前にそれぞれから取る件数
+HYBRID_DENSE_MODE = os.getenv("HYBRID_DENSE_MODE", "exact")            # ハイブリッドで使うベクトル検索の方式
+
+SEPARATOR = re.compile(r"[\W_]+")   # 句読点・記号・空白で区切る（n-gramがそれらをまたがないように）
+
+
+def ngrams(text, sizes=NGRAM_SIZES):
+    grams = []
+    for segment in SEPARATOR.split(text):
+        if len(segment) < min(sizes):
+            # 1文字だけの区間はそのまま語にする
+            if segment:
+                grams.append(segment)
+            continue
+        for n in sizes:
+            grams.extend(segment[i:i + n] for i in range(len(segment) - n + 1))
+    return grams
+
+
+class BM25Index:
+    """文字n-gramの転置インデックスとBM25によるスコア付け。クエリのembeddingは使わない"""
+
+    uses_embedding = False
+
+    def __init__(self, vocab, offsets, docs, tf, lengths, k1=BM25_K1, b=BM25_B):
+        self.vocab = vocab
+        self.offsets = offsets
+        self.docs = docs
+        self.tf = tf
+        self.lengths = lengths
+        self.k1 = k1
+        self.b = b
+
+        # 検索のたびに計算しなくて済むよう、idfと文書長による正規化を先に求めておく
+        n = len(lengths)
+        df = np.diff(offsets)
+        self.idf = np.log1p((n - df + 0.5) / (df + 0.5)).astype(np.float32)
+        avg_length = float(lengths.mean()) if n else 1.0
+        self.norm = (k1 * (1 - b + b * lengths / max(avg_length, 1.0))).astype(np.float32)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @classmethod
+    def build(cls, texts, sizes=NGRAM_SIZES):
+        # texts は1回読めればよい（インデックスの本文を1件ずつ渡せる）
+        # ポスティングはPythonのintのリストではなく型付きの配列に溜める（1件あたり数バイト）
+        vocab = {}
+        term_ids = array("q")
+        doc_ids = array("I")
+        counts = array("I")
+        lengths = array("I")
+        for doc, text in enumerate(texts):
+            grams = Counter(ngrams(text, sizes))
+            lengths.append(sum(grams.values()))
+            for gram, count in grams.items():
+                term_ids.append(vocab.setdefault(gram, len(vocab)))
+                doc_ids.append(doc)
+                counts.append(count)
+
+        # 語の番号順（同じ語の中ではチャンク番号順）に並べてCSR形式にする
+        term_ids = np.frombuffer(term_ids, dtype=np.int64)
+        order = np.argsort(term_ids, kind="stable")
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(term_ids, minlength=len(vocab))))).astype(np.int64)
+        docs = np.frombuffer(doc_ids, dtype=np.uint32)[order]
+        tf = np.minimum(np.frombuffer(counts, dtype=np.uint32), np.iinfo(np.uint16).max).astype(np.uint16)[order]
+        return cls(vocab, offsets, docs, tf, np.frombuffer(lengths, dtype=np.uint32).copy())
+
+    def save(self, path):
+        terms = sorted(self.vocab, key=self.vocab.get)
+        with atomic_open(os.path.join(path, BM25_VOCAB_FILE), "w", encoding="utf-8") as f:
+            json.dump(terms, f, ensure_ascii=False)
+        for name, array in (
+            (BM25_OFFSETS_FILE, self.offsets),
+            (BM25_DOCS_FILE, self.docs),
+            (BM25_TF_FILE, self.tf),
+            (BM25_LENGTHS_FILE, self.lengths),
+        ):
+            with atomic_open(os.path.join(path, name)) as f:
+                np.save(f, array)
+        with atomic_open(os.path.join(path, BM25_META_FILE), "w", encoding="utf-8") as f:
+            json.dump({"count": len(self), "terms": len(terms), "postings": len(self.docs),
+                       "ngram_sizes": list(NGRAM_SIZES)}, f)
+
+    @classmethod
+    def load(cls, index):
+        meta_path = os.path.join(index.path, BM25_META_FILE)
+        if not os.path.exists(meta_path):
+            raise FileNotFoundError(
+                f"{meta_path} がありません。python lexical.py {index.path} で作成してください"
+            )
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta["count"] != len(index):
+            raise ValueError(
+                f"BM25 index is stale ({meta['count']} != {len(index)} chunks); rebuild with lexical.py"
+            )
+
+        with open(os.path.join(index.path, BM25_VOCAB_FILE), encoding="utf-8") as f:
+            vocab = {term: i for i, term in enumerate(json.load(f))}
+        return cls(
+            vocab,
+            np.load(os.path.join(index.path, BM25_OFFSETS_FILE)),
+            np.load(os.path.join(index.path, BM25_DOCS_FILE), mmap_mode="r"),
+            np.load(os.path.join(index.path, BM25_TF_FILE), mmap_mode="r"),
+            np.load(os.path.join(index.path, BM25_LENGTHS_FILE)),
+        )
+
+    def search(self, query_text, k=TOP_K):
+        # クエリに含まれる語のポスティングだけを読み、出現したチャンクだけを集計する
+        query_terms = Counter(
+            self.vocab[gram] for gram in ngrams(query_text) if gram in self.vocab
+        )
+        if not query_terms:
+            return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64)
+
+        docs = []
+        weights = []
+        for term, count in query_terms.items():
+            start, end = self.offsets[term], self.offsets[term + 1]
+            term_docs = np.asarray(self.docs[start:end], dtype=np.int64)
+            tf = np.asarray(self.tf[start:end], dtype=np.float32)
+            docs.append(term_docs)
+            weights.append(count * self.idf[term] * tf * (self.k1 + 1) / (tf + self.norm[term_docs]))
+
+        candidates, inverse = np.unique(np.concatenate(docs), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(weights)).astype(np.float32)
+        top_scores, order = top_k(scores, k)
+        return top_scores, candidates[order]
+
+
+def rrf(rankings, k=TOP_K, rrf_k=RRF_K):
+    # 各ランキングでの順位 r に 1 / (rrf_k + r) を与えて合計する（スコアの尺度をそろえなくてよい）
+    ids = []
+    weights = []
+    for ranking in rankings:
+        ranking = np.asarray(ranking, dtype=np.int64)
+        ranking = ranking[ranking >= 0]
+        ids.append(ranking)
+        weights.append(1.0 / (rrf_k + 1 + np.arange(len(ranking))))
+    ids = np.concatenate(ids)
+    if not len(ids):
+        return np.zeros(0, dtype=np.float32), ids
+    candidates, inverse = np.unique(ids, return_inverse=True)
+    scores = np.bincount(inverse, weights=np.concatenate(weights)).astype(np.float32)
+    top_scores, order = top_k(scores, k)
+    return top_scores, candidates[order]
+
+
+class HybridRetriever:
+    """ベクトル検索とBM25の上位候補を Reciprocal Rank Fusion で統合する"""
+
+    uses_text = True
+
+    def __init__(self, dense, lexical, candidates=HYBRID_CANDIDATES, rrf_k=RRF_K):
+        self.dense = dense
+        self.lexical = lexical
+        self.candidates = candidates
+        self.rrf_k = rrf_k
+
+    def __len__(self):
+        return len(self.lexical)
+
+    def search(self, query_vec, k=TOP_K, query_text=""):
+        _, dense_ids = self.dense.search(query_vec, self.candidates)
+        _, lexical_ids = self.lexical.search(query_text, self.candidates)
+        return rrf([dense_ids, lexical_ids], k, self.rrf_k)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="BM25（文字n-gram）の転置インデックスを作成し、検索の速さを表示する")
+    parser.add_argument("index", nargs="?", default=os.getenv("INDEX_DIR", "kenji_index"))
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--query-chars", type=int, default=20, help="擬似クエリとしてチャンクから切り出す文字数")
+    parser.add_argument("-k", type=int, default=TOP_K)
+    args = parser.parse_args()
+
+    index = load_index(args.index)
+    start = time.perf_counter()
+    bm25 = BM25Index.build(c["text"] for c in index.chunks)
+    bm25.save(args.index)
+    size = sum(a.nbytes for a in (bm25.offsets, bm25.docs, bm25.tf, bm25.lengths))
+    print(
+        f"{len(index)} chunks, {len(bm25.vocab)} terms, {len(bm25.docs)} postings "
+        f"({size / 2**20:.1f} MiB), built in {time.perf_counter() - start:.1f}s"
+    )
+
+    # チャンクの一部をクエリにして、元のチャンクが上位k件に入るかを見る
+    rng = np.random.default_rng(0)
+    rows = rng.choice(len(index), min(args.queries, len(index)), replace=False)
+    queries = []
+    for row in rows:
+        text = index.chunks[int(row)]["text"]
+        offset = int(rng.integers(0, max(1, len(text) - args.query_chars)))
+        queries.append((int(row), text[offset:offset + args.query_chars]))
+
+    start = time.perf_counter()
+    hits = sum(row in bm25.search(query, args.k)[1] for row, query in queries)
+    latency = (time.perf_counter() - start) / len(queries) * 1000
+    print(f"hit@{args.k}={hits / len(queries):.3f}  {latency:.3f} ms/query")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import os
+
+from ratelimit import INTERACTIVE
+from tokens import count_tokens
+
+COMPLETION_ESTIMATE = int(os.getenv("COMPLETION_TOKEN_ESTIMATE", "400"))   # 生成トークン数の見積もり
+
+
+def estimate_tokens(messages, model=None):
+    # 呼び出し前にレート制限の枠を取るための見積もり（呼び出し後に実際の値で補正する）
+    return sum(count_tokens(m["content"], model) + 4 for m in messages) + COMPLETION_ESTIMATE
+
+
+class ChatStream:
+    """chat.completions をストリーミングで呼び出し、生成された分から順に返す
+
+    for delta in stream: ... で読み終えると、text に回答全体、usage にトークン数が入る
+    """
+
+    def __init__(self, client, model, messages, scheduler=None, priority=INTERACTIVE):
+        self.client = client
+        self.model = model
+        self.messages = messages
+        self.scheduler = scheduler
+        self.priority = priority
+        self.text = ""
+        self.usage = None
+
+    def _create(self):
+        return self.client.chat.completions.create(
+            model=self.model,
+            messages=self.messages,
+            stream=True,
+            # 最後のチャンクでトークン数を返してもらう
+            stream_options={"include_usage": True},
+        )
+
+    def _settle(self, estimate):
+        if self.scheduler is not None and self.usage is not None:
+            self.scheduler.chat.settle(estimate, self.usage.total_tokens)
+
+    def __iter__(self):
+        # スケジューラがあれば枠を取ってから呼ぶ（リトライはストリーム開始前まで）
+        estimate = estimate_tokens(self.messages, self.model)
+        if self.scheduler is None:
+            stream = self._create()
+        else:
+            stream = self.scheduler.chat.call(self._create, estimate, self.priority)
+
+        parts = []
+        for chunk in stream:
+            if chunk.usage is not None:
+                self.usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                delta = chunk.choices[0].delta.content
+                parts.append(delta)
+                yield delta
+
+        self.text = "".join(parts)
+        self._settle(estimate)
+
+
+class AsyncChatStream(ChatStream):
+    """ChatStream の AsyncOpenAI 版。async for delta in stream: ... で読む"""
+
+    async def __aiter__(self):
+        estimate = estimate_tokens(self.messages, self.model)
+        if self.scheduler is None:
+            stream = await self._create()
+        else:
+            stream = await self.scheduler.chat.acall(self._create, estimate, self.priority)
+
+        parts = []
+        async for chunk in stream:
+            if chunk.usage is not None:
+                self.usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                delta = chunk.choices[0].delta.content
+                parts.append(delta)
+                yield delta
+
+        self.text = "".join(parts)
+        self._settle(estimate)
+
+
+def format_usage(usage):
+    return (
+        f"tokens | input: {usage.prompt_tokens}, "
+        f"output: {usage.completion_tokens}, "
+        f"total: {usage.total_tokens}"
+    )
@@ -0,0 +1,142 @@
+import json
+import time
+import random
+import asyncio
+import argparse
+
+import aiohttp
+import numpy as np
+
+# server.py に N 本の会話を同時に流し、スループットと遅延のパーセンタイルを測る
+# 料金をかけずに測るときは mock_openai.py を起動し、OPENAI_BASE_URL を向けた server.py に対して実行する
+QUESTIONS = [
+    "銀河鉄道はどこへ向かうのですか。",
+    "ほんとうのさいわいとは何でしょう。",
+    "雨の日にはどんなことを考えますか。",
+    "風の又三郎はどこから来たのですか。",
+    "星めぐりの歌を教えてください。",
+    "注文の多い料理店の話をしてください。",
+    "農業についてどう思いますか。",
+    "イーハトーブとはどんなところですか。",
+    "よだかはなぜ星になったのですか。",
+    "あなたの好きな季節はいつですか。",
+    # 検索の要らないターン（あいさつ・続きを求める質問）
+    "ありがとう。",
+    "もっと詳しく教えてください。",
+]
+PERCENTILES = (50, 90, 99)
+
+
+async def read_events(response):
+    # SSE の (イベント名, データ) を順に返す
+    event = None
+    async for raw in response.content:
+        line = raw.decode("utf-8").rstrip("\n")
+        if line.startswith("event: "):
+            event = line[len("event: "):]
+        elif line.startswith("data: "):
+            yield event, json.loads(line[len("data: "):])
+
+
+async def run_turn(session, url, conversation_id, question):
+    start = time.perf_counter()
+    first_token = None
+    result = {"ok": False, "cached": False}
+    async with session.post(f"{url}/conversations/{conversation_id}/messages", json={"content": question}) as response:
+        async for event, data in read_events(response):
+            if event == "delta" and first_token is None:
+                first_token = time.perf_counter() - start
+            elif event == "done":
+                result = {"ok": True, "cached": data["cached"], "usage": data.get("usage")}
+            elif event == "error":
+                result = {"ok": False, "error": data["error"]}
+    result["latency"] = time.perf_counter() - start
+    result["ttft"] = first_token
+    return result
+
+
+async def run_conversation(session, url, turns, rng, think_time):
+    async with session.post(f"{url}/conversations") as response:
+        conversation_id = (await response.json())["id"]
+    results = []
+    for _ in range(turns):
+        results.append(await run_turn(session, url, conversation_id, rng.choice(QUESTIONS)))
+        if think_time:
+            await asyncio.sleep(rng.uniform(0, think_time))
+    return results
+
+
+def percentiles(values):
+    if not values:
+        return {f"p{p}": None for p in PERCENTILES}
+    return {f"p{p}": float(np.percentile(values, p)) for p in PERCENTILES}
+
+
+async def run(url, conversations, turns, concurrency, think_time, seed):
+    semaphore = asyncio.Semaphore(concurrency or conversations)
+    timeout = aiohttp.ClientTimeout(total=None)
+
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        async def one(i):
+            async with semaphore:
+                return await run_conversation(session, url, turns, random.Random(seed + i), think_time)
+
+        start = time.perf_counter()
+        per_conversation = await asyncio.gather(*(one(i) for i in range(conversations)))
+        elapsed = time.perf_counter() - start
+
+        async with session.get(f"{url}/healthz") as response:
+            health = await response.json()
+
+    results = [r for rs in per_conversation for r in rs]
+    ok = [r for r in results if r["ok"]]
+    completion_tokens = sum(r["usage"]["completion_tokens"] for r in ok if r.get("usage"))
+    return {
+        "conversations": conversations,
+        "turns": len(results),
+        "errors": len(results) - len(ok),
+        "cached": sum(r["cached"] for r in ok),
+        "elapsed_s": elapsed,
+        "turns_per_s": len(ok) / elapsed if elapsed else 0.0,
+        "completion_tokens_per_s": completion_tokens / elapsed if elapsed else 0.0,
+        "latency_s": percentiles([r["latency"] for r in ok]),
+        "ttft_s": percentiles([r["ttft"] for r in ok if r["ttft"] is not None]),
+        "server": health,
+    }
+
+
+def format_report(report):
+    def p(values):
+        return ", ".join(f"{k}: {v * 1000:.0f}ms" if v is not None else f"{k}: -" for k, v in values.items())
+
+    return "\n".join([
+        f"{report['conversations']} conversations, {report['turns']} turns "
+        f"({report['errors']} errors, {report['cached']} cached) in {report['elapsed_s']:.1f}s",
+        f"throughput | {report['turns_per_s']:.2f} turns/s, {report['completion_tokens_per_s']:.0f} output tokens/s",
+        f"latency    | {p(report['latency_s'])}",
+        f"first token| {p(report['ttft_s'])}",
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="賢治botサーバーへの負荷試験（N本の会話を同時に流す）")
+    parser.add_argument("--url", default="http://127.0.0.1:8080")
+    parser.add_argument("--conversations", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=3, help="会話ごとのターン数")
+    parser.add_argument("--concurrency", type=int, default=0, help="同時に進める会話数（0なら全部）")
+    parser.add_argument("--think-time", type=float, default=0.0, help="ターン間の待ち時間の上限（秒）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(
+        args.url, args.conversations, args.turns, args.concurrency, args.think_time, args.seed
+    ))
+    print(format_report(report))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+from store import atomic_open
+
+METRICS_JSONL = os.getenv("METRICS_JSONL", "metrics.jsonl")   # ターンごとの記録（空なら出力しない）
+METRICS_PROM = os.getenv("METRICS_PROM", "")                   # Prometheusテキスト形式（空なら出力しない）
+
+# 料金（USD / 100万トークン）。0 のままなら費用は 0 と表示される
+PRICE_INPUT = float(os.getenv("PRICE_INPUT_PER_1M", "0"))
+PRICE_OUTPUT = float(os.getenv("PRICE_OUTPUT_PER_1M", "0"))
+
+STAGES = (
+    "index_load", "query_embedding", "scoring", "top_k",
+    "prompt_assembly", "llm_first_token", "llm_completion",
+)
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, float("inf"))
+SAMPLES = 10000   # パーセンタイル計算用に残す直近の件数
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS_MS)
+        self.total = 0.0
+        self.n = 0
+        self.samples = deque(maxlen=SAMPLES)
+
+    def observe(self, ms):
+        for i, bound in enumerate(BUCKETS_MS):
+            if ms <= bound:
+                self.counts[i] += 1
+                break
+        self.total += ms
+        self.n += 1
+        self.samples.append(ms)
+
+    def percentile(self, q):
+        return float(np.percentile(self.samples, q)) if self.samples else 0.0
+
+
+class Trace:
+    """1ターン分の計測。with trace.stage("scoring"): ... で区間の時間を記録する"""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+        self._starts = {}
+
+    def start(self, name):
+        self._starts[name] = time.perf_counter()
+
+    def stop(self, name):
+        ms = (time.perf_counter() - self._starts[name]) * 1000
+        self.stages[name] = self.stages.get(name, 0.0) + ms
+
+    @contextmanager
+    def stage(self, name):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop(name)
+
+    def mark_once(self, name, since):
+        # 例: 最初のトークンが届いた時点を、生成開始からの経過時間として1回だけ記録する
+        if name not in self.stages and since in self._starts:
+            self.stages[name] = (time.perf_counter() - self._starts[since]) * 1000
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_usage(self, usage):
+        if usage is not None:
+            self.count("prompt_tokens", usage.prompt_tokens)
+            self.count("completion_tokens", usage.completion_tokens)
+
+    def finish(self):
+        self.metrics.record(self)
+
+
+class Metrics:
+    """区間ごとのレイテンシのヒストグラムとトークン・費用のカウンタ"""
+
+    def __init__(self, jsonl_path=METRICS_JSONL, prom_path=METRICS_PROM):
+        self.jsonl_path = jsonl_path
+        self.prom_path = prom_path
+        self.histograms = {}
+        self.counters = {}
+        self.turns = 0
+        self._lock = threading.Lock()
+
+    def turn(self):
+        return Trace(self)
+
+    def observe(self, name, ms):
+        with self._lock:
+            self.histograms.setdefault(name, Histogram()).observe(ms)
+
+    def record(self, trace):
+        cost = (
+            trace.counters.get("prompt_tokens", 0) * PRICE_INPUT
+            + trace.counters.get("completion_tokens", 0) * PRICE_OUTPUT
+        ) / 1e6
+
+        with self._lock:
+            self.turns += 1
+            for name, ms in trace.stages.items():
+                self.histograms.setdefault(name, Histogram()).observe(ms)
+            for name, n in trace.counters.items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            self.counters["cost_usd"] = self.counters.get("cost_usd", 0.0) + cost
+
+            if self.jsonl_path:
+                with open(self.jsonl_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({
+                        "time": trace.started,
+                        "stages_ms": {k: round(v, 3) for k, v in trace.stages.items()},
+                        "counters": trace.counters,
+                        "cost_usd": cost,
+                    }) + "\n")
+
+        if self.prom_path:
+            self.write_prometheus(self.prom_path)
+
+    def prometheus(self):
+        lines = [
+            "# TYPE kenji_stage_latency_ms histogram",
+        ]
+        with self._lock:
+            for name, h in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS_MS, h.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    lines.append(f'kenji_stage_latency_ms_bucket{{stage="{name}",le="{le}"}} {cumulative}')
+                lines.append(f'kenji_stage_latency_ms_sum{{stage="{name}"}} {h.total:.3f}')
+                lines.append(f'kenji_stage_latency_ms_count{{stage="{name}"}} {h.n}')
+            lines.append("# TYPE kenji_turns_total counter")
+            lines.append(f"kenji_turns_total {self.turns}")
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE kenji_{name}_total counter")
+                lines.append(f"kenji_{name}_total {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        with atomic_open(path, "w", encoding="utf-8") as f:
+            f.write(self.prometheus())
+
+    def summary(self):
+        with self._lock:
+            lines = [f"metrics | {self.turns} turns"]
+            names = [s for s in STAGES if s in self.histograms]
+            names += sorted(set(self.histograms) - set(STAGES))
+            for name in names:
+                h = self.histograms[name]
+                lines.append(
+                    f"  {name:<16} n={h.n:<5d} mean={h.total / h.n:8.1f}ms "
+                    f"p50={h.percentile(50):8.1f}ms p95={h.percentile(95):8.1f}ms"
+                )
+            counters = ", ".join(
+                f"{k}: {v:.4f}" if isinstance(v, float) else f"{k}: {v}"
+                for k, v in sorted(self.counters.items())
+            )
+            if counters:
+                lines.append(f"  {counters}")
+        return "\n".join(lines)
@@ -0,0 +1,223 @@
+import os
+import json
+import time
+import zlib
+import base64
+import random
+import asyncio
+import argparse
+
+import numpy as np
+from aiohttp import web
+
+from ratelimit import TokenBucket
+from store import l2_normalize
+from tokens import count_tokens
+
+# 使い方: このサーバーを起動し、OPENAI_BASE_URL=http://127.0.0.1:8090/v1 を設定して
+# chat_bot.py / app.py / server.py / ingest.py を動かすと、料金もネットワークもなしで全体を試せる
+EMBEDDING_DIM = int(os.getenv("MOCK_EMBEDDING_DIM", "1536"))
+LATENCY_MS = float(os.getenv("MOCK_LATENCY_MS", "200"))              # 応答（最初のトークン）までの時間
+TOKEN_LATENCY_MS = float(os.getenv("MOCK_TOKEN_LATENCY_MS", "20"))   # 1チャンクごとの生成時間
+EMBEDDING_LATENCY_MS = float(os.getenv("MOCK_EMBEDDING_LATENCY_MS", "50"))
+COMPLETION_CHARS = int(os.getenv("MOCK_COMPLETION_CHARS", "200"))    # 返答の長さ（文字数）
+CHARS_PER_CHUNK = 2
+RPM = int(os.getenv("MOCK_RPM", "0"))                                # 超えたら 429 を返す（0なら無制限）
+ERROR_RATE = float(os.getenv("MOCK_429_RATE", "0"))                  # この割合でランダムに 429 を返す
+
+# 返答の材料（賢治の作品からの短い言い回し）
+PHRASES = [
+    "雨ニモマケズ、風ニモマケズ。",
+    "わたくしといふ現象は、仮定された有機交流電燈のひとつの青い照明です。",
+    "ほんたうのさいはひは一体何だらう。",
+    "銀河の岸に、小さな三角標がいくつも光ってゐます。",
+    "風がどうと吹いて、草はざわざわ鳴りました。",
+    "すきとほったほんたうのたべものになることを、どんなにねがふかわかりません。",
+    "あの青い野原のむかふに、まだ見たこともない町があるのです。",
+]
+
+
+def pseudo_embedding(text, dim=EMBEDDING_DIM):
+    # 文字bigramを特徴ハッシュで dim 次元に落とす: 同じ文は同じベクトル、似た文は近いベクトルになる
+    vector = np.zeros(dim, dtype=np.float32)
+    text = text or " "
+    grams = [text[i:i + 2] for i in range(max(1, len(text) - 1))]
+    for gram in grams:
+        h = zlib.crc32(gram.encode("utf-8"))
+        vector[h % dim] += 1.0 if (h >> 31) & 1 else -1.0
+    return l2_normalize(vector)
+
+
+def canned_reply(messages, length=COMPLETION_CHARS):
+    # 最後のユーザー発言から決まる固定の返答（同じ入力なら毎回同じ）
+    last = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+    rng = random.Random(zlib.crc32(last.encode("utf-8")))
+    parts = []
+    while sum(len(p) for p in parts) < length:
+        parts.append(rng.choice(PHRASES))
+    return "".join(parts)[:length]
+
+
+def prompt_tokens(messages, model=None):
+    return sum(count_tokens(m["content"], model) + 4 for m in messages) + 3
+
+
+class MockOpenAI:
+    """OpenAI API の embeddings と chat.completions だけを真似るローカルサーバー"""
+
+    def __init__(self, dim=EMBEDDING_DIM, latency_ms=LATENCY_MS, token_latency_ms=TOKEN_LATENCY_MS,
+                 embedding_latency_ms=EMBEDDING_LATENCY_MS, rpm=RPM, error_rate=ERROR_RATE, seed=0):
+        self.dim = dim
+        self.latency = latency_ms / 1000
+        self.token_latency = token_latency_ms / 1000
+        self.embedding_latency = embedding_latency_ms / 1000
+        self.requests = TokenBucket(rpm)
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.counts = {"embeddings": 0, "chat": 0, "rate_limited": 0}
+
+    def rate_limited(self):
+        # RPMを超えたか、ランダムに選ばれたら 429 を返す（Retry-After 付き）
+        wait = self.requests.wait_time(1)
+        if wait == 0 and self.rng.random() >= self.error_rate:
+            self.requests.consume(1)
+            return None
+        self.counts["rate_limited"] += 1
+        return web.json_response(
+            {"error": {"message": "Rate limit reached (mock)", "type": "requests", "code": "rate_limit_exceeded"}},
+            status=429,
+            headers={"retry-after": f"{max(wait, 0.1):.2f}"},
+        )
+
+    async def embeddings(self, request):
+        if (error := self.rate_limited()) is not None:
+            return error
+        body = await request.json()
+        texts = body["input"]
+        if isinstance(texts, str):
+            texts = [texts]
+        self.counts["embeddings"] += 1
+        await asyncio.sleep(self.embedding_latency)
+
+        dim = body.get("dimensions") or self.dim
+        data = []
+        for i, text in enumerate(texts):
+            vector = pseudo_embedding(text, dim)
+            # openai のクライアントは既定で base64 を要求する
+            if body.get("encoding_format") == "base64":
+                embedding = base64.b64encode(vector.astype("<f4").tobytes()).decode("ascii")
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+
+        tokens = sum(count_tokens(t) for t in texts)
+        return web.json_response({
+            "object": "list",
+            "data": data,
+            "model": body.get("model"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        })
+
+    async def chat_completions(self, request):
+        if (error := self.rate_limited()) is not None:
+            return error
+        body = await request.json()
+        messages = body["messages"]
+        model = body.get("model")
+        self.counts["chat"] += 1
+
+        reply = canned_reply(messages)
+        usage = {
+            "prompt_tokens": prompt_tokens(messages, model),
+            "completion_tokens": count_tokens(reply, model),
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        completion_id = f"chatcmpl-mock{self.counts['chat']}"
+        created = int(time.time())
+
+        await asyncio.sleep(self.latency)
+
+        if not body.get("stream"):
+            await asyncio.sleep(self.token_latency * len(reply) / CHARS_PER_CHUNK)
+            return web.json_response({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": reply},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send(choices, usage=None):
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": choices,
+                "usage": usage,
+            }
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+        await send([{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}])
+        for start in range(0, len(reply), CHARS_PER_CHUNK):
+            await send([{"index": 0, "delta": {"content": reply[start:start + CHARS_PER_CHUNK]}, "finish_reason": None}])
+            await asyncio.sleep(self.token_latency)
+        await send([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        if (body.get("stream_options") or {}).get("include_usage"):
+            await send([], usage)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def stats(self, request):
+        return web.json_response(self.counts)
+
+
+def make_app(mock):
+    app = web.Application()
+    app.add_routes([
+        web.post("/v1/embeddings", mock.embeddings),
+        web.post("/v1/chat/completions", mock.chat_completions),
+        web.get("/stats", mock.stats),
+    ])
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="OpenAI APIの代わりになるローカルサーバー（OPENAI_BASE_URL=http://HOST:PORT/v1 で使う）"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--dim", type=int, default=EMBEDDING_DIM, help="embeddingの次元数")
+    parser.add_argument("--latency-ms", type=float, default=LATENCY_MS, help="最初のトークンまでの時間")
+    parser.add_argument("--token-latency-ms", type=float, default=TOKEN_LATENCY_MS, help="チャンクごとの生成時間")
+    parser.add_argument("--embedding-latency-ms", type=float, default=EMBEDDING_LATENCY_MS)
+    parser.add_argument("--rpm", type=int, default=RPM, help="超えたら429を返す（0なら無制限）")
+    parser.add_argument("--429-rate", dest="error_rate", type=float, default=ERROR_RATE,
+                        help="ランダムに429を返す割合")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    mock = MockOpenAI(
+        dim=args.dim,
+        latency_ms=args.latency_ms,
+        token_latency_ms=args.token_latency_ms,
+        embedding_latency_ms=args.embedding_latency_ms,
+        rpm=args.rpm,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
+    web.run_app(make_app(mock), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
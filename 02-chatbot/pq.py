@@ -0,0 +1,197 @@
+import os
+import json
+import argparse
+import numpy as np
+
+from ann import kmeans
+from retriever import (
+    TOP_K, BLOCK_ROWS, ExactRetriever, evaluate, prepare_queries, rerank, sample_queries, stack_results,
+    top_k,
+)
+from store import atomic_open, load_index
+
+# インデックスディレクトリに embeddings.npy と並べて保存する
+PQ_META_FILE = "pq.json"
+PQ_CODEBOOKS_FILE = "pq_codebooks.npy"   # 部分空間ごとの代表ベクトル (M, 256, D / M)
+PQ_CODES_FILE = "pq_codes.npy"           # チャンクごとの代表ベクトル番号 (N, M) uint8
+
+N_SUBSPACES = 64       # 1536次元なら24次元ずつ、1チャンク64バイト
+N_CENTROIDS = 256      # uint8に収まる数
+TRAIN_SIZE = 65536     # 学習に使うサンプル数
+HOLDOUT_SIZE = 4096    # 学習に使わなかった行から、再構成誤差を測るサンプル数
+RERANK = int(os.getenv("PQ_RERANK", "100"))
+
+
+class PQIndex:
+    """直積量子化: ベクトルをM個の部分空間に分け、それぞれを256個の代表ベクトルの番号で表す"""
+
+    def __init__(self, embeddings, codebooks, codes, rerank=RERANK, error=None):
+        self.embeddings = embeddings
+        self.codebooks = codebooks
+        self.codes = codes
+        self.rerank = rerank
+        self.error = error   # 学習時の、学習サンプルの二乗再構成誤差の平均
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def n_subspaces(self):
+        return len(self.codebooks)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.codebooks.nbytes
+
+    def split(self, x):
+        # (n, D) -> (n, M, D / M)
+        return np.asarray(x, dtype=np.float32).reshape(len(x), self.n_subspaces, -1)
+
+    @classmethod
+    def build(cls, embeddings, n_subspaces=N_SUBSPACES, rerank=RERANK, seed=0):
+        dim = embeddings.shape[1]
+        if dim % n_subspaces:
+            raise ValueError(f"dimension {dim} is not divisible by n_subspaces={n_subspaces}")
+
+        rng = np.random.default_rng(seed)
+        rows = np.sort(rng.choice(len(embeddings), min(TRAIN_SIZE, len(embeddings)), replace=False))
+        train = np.asarray(embeddings[rows], dtype=np.float32).reshape(len(rows), n_subspaces, -1)
+
+        # 部分空間ごとにユークリッド距離のk-meansで代表ベクトルを学習する
+        n_centroids = min(N_CENTROIDS, len(train))
+        codebooks = np.stack([
+            kmeans(train[:, m], n_centroids, spherical=False, seed=seed)
+            for m in range(n_subspaces)
+        ])
+
+        pq = cls(embeddings, codebooks, None, rerank)
+        pq.codes = pq.encode(embeddings)
+        # 差分更新で新しい行と比べられるよう、学習に使わなかった行で誤差を測る（全行を学習に使ったときは学習サンプルで）
+        held_out = np.setdiff1d(np.arange(len(embeddings)), rows)
+        if len(held_out):
+            held_out = np.sort(rng.choice(held_out, min(HOLDOUT_SIZE, len(held_out)), replace=False))
+            pq.error = pq.reconstruction_error(embeddings[held_out], pq.codes[held_out])
+        else:
+            pq.error = pq.reconstruction_error(train.reshape(len(rows), -1), pq.codes[rows])
+        return pq
+
+    @classmethod
+    def update(cls, previous, embeddings, old_rows, rerank=RERANK):
+        """前回の代表ベクトルを学習し直さずに使い、変わった行だけを符号化する
+
+        old_rows は新しい行ごとの前回の行番号（追加・変更された行は -1）。戻り値は (pq, drift) で、
+        drift は新しい行の再構成誤差が学習時よりどれだけ増えたかの割合（新しい行がなければ 0）。
+        """
+        pq = cls(embeddings, previous.codebooks, None, rerank, previous.error)
+        codes = np.empty((len(embeddings), pq.n_subspaces), dtype=np.uint8)
+        kept = old_rows >= 0
+        codes[kept] = previous.codes[old_rows[kept]]
+
+        drift = 0.0
+        changed = np.flatnonzero(~kept)
+        if len(changed):
+            vectors = np.asarray(embeddings[changed], dtype=np.float32)
+            codes[changed] = pq.encode(vectors)
+            error = pq.reconstruction_error(vectors, codes[changed])
+            drift = (error - previous.error) / max(previous.error, 1e-12)
+        pq.codes = codes
+        return pq, drift
+
+    def reconstruction_error(self, x, codes):
+        # 代表ベクトルで置き換えたときの二乗誤差の平均
+        decoded = self.codebooks[np.arange(self.n_subspaces), np.asarray(codes)]
+        return float(np.mean(np.sum((self.split(x) - decoded) ** 2, axis=(1, 2))))
+
+    def encode(self, x):
+        codes = np.empty((len(x), self.n_subspaces), dtype=np.uint8)
+        # ||x - c||^2 の最小化は x・c - ||c||^2 / 2 の最大化と同じ
+        bias = -0.5 * np.einsum("mcd,mcd->mc", self.codebooks, self.codebooks)
+        for start in range(0, len(x), BLOCK_ROWS):
+            block = self.split(x[start:start + BLOCK_ROWS])
+            sims = np.einsum("nmd,mcd->nmc", block, self.codebooks) + bias
+            codes[start:start + len(block)] = np.argmax(sims, axis=2)
+        return codes
+
+    def save(self, path):
+        with atomic_open(os.path.join(path, PQ_CODEBOOKS_FILE)) as f:
+            np.save(f, self.codebooks)
+        with atomic_open(os.path.join(path, PQ_CODES_FILE)) as f:
+            np.save(f, self.codes)
+        with atomic_open(os.path.join(path, PQ_META_FILE), "w", encoding="utf-8") as f:
+            json.dump({"n_subspaces": self.n_subspaces, "count": len(self), "error": self.error}, f)
+
+    @classmethod
+    def load(cls, index, rerank=RERANK):
+        meta_path = os.path.join(index.path, PQ_META_FILE)
+        if not os.path.exists(meta_path):
+            raise FileNotFoundError(
+                f"{meta_path} がありません。python pq.py {index.path} で作成してください"
+            )
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta["count"] != len(index):
+            raise ValueError(
+                f"PQ index is stale ({meta['count']} != {len(index)} chunks); rebuild with pq.py"
+            )
+
+        return cls(
+            index.embeddings,
+            np.load(os.path.join(index.path, PQ_CODEBOOKS_FILE)),
+            np.load(os.path.join(index.path, PQ_CODES_FILE), mmap_mode="r"),
+            rerank,
+            meta.get("error"),
+        )
+
+    def distance_table(self, query):
+        # 非対称距離: クエリは量子化せず、部分空間ごとに代表ベクトルとの内積表 (M, 256) を作る
+        return np.einsum("md,mcd->mc", self.split(query[None])[0], self.codebooks)
+
+    def score(self, query):
+        table = self.distance_table(query)
+        subspaces = np.arange(self.n_subspaces)
+        scores = np.empty(len(self.codes), dtype=np.float32)
+        for start in range(0, len(self.codes), BLOCK_ROWS):
+            block = np.asarray(self.codes[start:start + BLOCK_ROWS])
+            scores[start:start + len(block)] = table[subspaces, block].sum(axis=1)
+        return scores
+
+    def search(self, query_vec, k=TOP_K, rerank_candidates=None):
+        queries, single = prepare_queries(query_vec)
+        n_cand = self.rerank if rerank_candidates is None else rerank_candidates
+
+        results = []
+        for query in queries:
+            coarse_scores, coarse_ids = top_k(self.score(query), max(k, n_cand))
+            # rerank_candidates=0 なら近似スコアの結果をそのまま返す
+            if n_cand == 0:
+                results.append((coarse_scores[:k], coarse_ids[:k]))
+            else:
+                results.append(rerank(self.embeddings, query, coarse_ids, k))
+        return stack_results(results, k, single)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="直積量子化インデックスを作成し、メモリ量とrecallを表示する")
+    parser.add_argument("index", nargs="?", default=os.getenv("INDEX_DIR", "kenji_index"))
+    parser.add_argument("--subspaces", type=int, default=N_SUBSPACES)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=TOP_K)
+    args = parser.parse_args()
+
+    index = load_index(args.index)
+    pq = PQIndex.build(index.embeddings, args.subspaces)
+    pq.save(args.index)
+
+    full_bytes = index.embeddings.shape[1] * 4
+    print(f"{len(index)} chunks, {pq.n_subspaces} bytes/chunk (float32: {full_bytes} bytes/chunk), "
+          f"codebooks {pq.codebooks.nbytes / 2**20:.1f} MiB")
+
+    exact = ExactRetriever(index.embeddings)
+    queries = sample_queries(index.embeddings, args.queries)
+    for n_cand in (0, args.k * 10, RERANK):
+        recall, latency = evaluate(pq, exact, queries, args.k, rerank_candidates=n_cand)
+        print(f"rerank={n_cand:<4d}  recall@{args.k}={recall:.3f}  {latency:.2f} ms/query")
+
+
+if __name__ == "__main__":
+    main()
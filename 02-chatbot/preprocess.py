@@ -0,0 +1,93 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from corpus import CHUNK_OVERLAP, CHUNK_TOKENS, TEXT_DIR, chunk_source, iter_source_files
+from store import atomic_open
+
+WORKERS = int(os.getenv("PREPROCESS_WORKERS", "0")) or os.cpu_count() or 1
+PENDING_PER_WORKER = 2   # 投入済みで結果を取り出していないファイル数の上限（ワーカーあたり）
+
+
+def process_file(job):
+    # ワーカープロセスで1ファイルを読み込み・前処理・チャンク分割する
+    # known_hash と同じ内容なら分割を省く（差分更新で変わっていないファイル）
+    name, path, known_hash, max_tokens, overlap, model = job
+    with open(path, "rb") as f:
+        data = f.read()
+    file_hash = hashlib.sha256(data).hexdigest()
+    if file_hash == known_hash:
+        return {"filename": name, "hash": file_hash, "chunks": None, "bytes": len(data)}
+    chunks = chunk_source(data.decode("utf-8"), name, max_tokens, overlap, model)
+    return {"filename": name, "hash": file_hash, "chunks": chunks, "bytes": len(data)}
+
+
+def iter_processed(text_dir=TEXT_DIR, max_tokens=CHUNK_TOKENS, overlap=CHUNK_OVERLAP, model=None,
+                   workers=WORKERS, known_hashes=None):
+    """ファイルを複数プロセスで前処理・分割し、ファイル名順に結果を返すジェネレータ
+
+    投入済みのファイル数を workers * PENDING_PER_WORKER までに抑えるので、
+    コーパス全体の大きさに関係なく、同時にメモリに載るのはその数のファイル分だけになる。
+    """
+    known_hashes = known_hashes or {}
+    jobs = (
+        (name, path, known_hashes.get(name), max_tokens, overlap, model)
+        for name, path in iter_source_files(text_dir)
+    )
+
+    if workers <= 1:
+        for job in jobs:
+            yield process_file(job)
+        return
+
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        for job in jobs:
+            pending.append(pool.submit(process_file, job))
+            if len(pending) >= workers * PENDING_PER_WORKER:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def write_chunks(items, out_path):
+    # チャンクをファイルごとにJSONLへ追記する（全体をメモリに溜めない）
+    stats = {"files": 0, "chunks": 0, "bytes": 0}
+    with atomic_open(out_path, "w", encoding="utf-8") as f:
+        for item in items:
+            for chunk in item["chunks"]:
+                f.write(json.dumps(chunk, ensure_ascii=False) + "\n")
+            stats["files"] += 1
+            stats["chunks"] += len(item["chunks"])
+            stats["bytes"] += item["bytes"]
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="コーパスを複数プロセスで前処理・チャンク分割し、JSONLに書き出す")
+    parser.add_argument("src", nargs="?", default=TEXT_DIR)
+    parser.add_argument("out", nargs="?", default="chunks.jsonl")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="プロセス数（1ならこのプロセスだけで処理する）")
+    parser.add_argument("--chunk-tokens", type=int, default=CHUNK_TOKENS)
+    parser.add_argument("--overlap", type=int, default=CHUNK_OVERLAP)
+    parser.add_argument("--model", default=os.getenv("EMBEDDING_MODEL"))
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    stats = write_chunks(
+        iter_processed(args.src, args.chunk_tokens, args.overlap, args.model, args.workers),
+        args.out,
+    )
+    elapsed = time.perf_counter() - start
+    print(
+        f"{stats['files']} files, {stats['chunks']} chunks -> {args.out} "
+        f"in {elapsed:.1f}s ({stats['bytes'] / 2**20 / elapsed:.1f} MiB/s, {args.workers} workers)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+import os
+
+from tokens import count_tokens, truncate_tokens
+
+PROMPT_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "2500"))   # 1ターンの入力トークン上限
+MESSAGE_OVERHEAD = 4      # メッセージ1件ごとに付く役割・区切りのトークン
+REPLY_OVERHEAD = 3        # 応答の開始に使われるトークン
+MIN_CHUNK_TOKENS = 50     # これより短くしか入らない参考文章は切り詰めずに落とす
+HISTORY_LIMIT = 100       # 保持しておく履歴の件数（プロンプトに入る件数は予算で決まる）
+CONTEXT_REFILL = int(os.getenv("CONTEXT_REFILL", "1"))     # 重複で空いた枠のうち、次の候補で埋める件数
+
+SYSTEM_PROMPT = """
+あなたは宮沢賢治の文体・語彙・世界観を強く反映して話す対話AIです。
+自然、宇宙、心象風景を大切にし、詩的だが会話として自然な返答をしてください。
+"""
+
+
+def message_tokens(content, model=None):
+    return count_tokens(content, model) + MESSAGE_OVERHEAD
+
+
+def context_message(texts, chunk_ids=None):
+    # 履歴に残す参考文章には、全文を入れた文章の番号を chunk_ids として付けておく
+    message = {"role": "system", "content": "参考文章:\n" + "\n\n".join(texts)}
+    if chunk_ids is not None:
+        message["chunk_ids"] = chunk_ids
+    return message
+
+
+def is_context(message):
+    return "chunk_ids" in message
+
+
+def fit_context(texts, available, model=None):
+    # 検索順位の高い順に available トークンまで詰める。戻り値は (texts, truncated, cost)
+    header_tokens = message_tokens("参考文章:\n", model)
+    if not texts or header_tokens >= available:
+        return [], 0, 0
+
+    used = header_tokens
+    kept = []
+    truncated = 0
+    for text in texts:
+        cost = count_tokens(text, model) + (2 if kept else 0)   # 区切りの "\n\n"
+        if used + cost <= available:
+            kept.append(text)
+            used += cost
+            continue
+        # 入りきらない分は、ある程度の長さが残るなら切り詰めて入れる
+        remaining = available - used - (2 if kept else 0)
+        if remaining >= MIN_CHUNK_TOKENS:
+            kept.append(truncate_tokens(text, remaining, model))
+            used += remaining + (2 if len(kept) > 1 else 0)
+            truncated += 1
+        break
+    if not kept:
+        return [], 0, 0
+    return kept, truncated, used
+
+
+def build_prompt(system_prompt, context_texts, history, user_input,
+                 budget=PROMPT_BUDGET, model=None, context_ids=None, k=None, refill=CONTEXT_REFILL):
+    """予算内に収まるようにメッセージを組み立てる
+
+    優先順位は システムプロンプト・ユーザー入力 → 参考文章（検索順位の高い順に上位k件） → 直近の履歴。
+    context_ids（候補の文章の番号）を渡すと、履歴に残した前のターンの参考文章のうち、今回の候補だけで
+    できていて予算に収まるものをプロンプトに残し、そこに含まれる文章は送り直さない。
+    送らずに済んだ分の枠は、k件目より後の候補で refill 件まで埋める。
+    戻り値は (messages, plan, context)。context はこのターンの参考文章のメッセージ（なければ None）で、
+    ユーザー入力の前に履歴へ追加しておくと次のターン以降の重複除去に使われる。
+    """
+    k = len(context_texts) if k is None else k
+    ids = [int(i) for i in context_ids] if context_ids is not None else None
+    system_message = {"role": "system", "content": system_prompt}
+    user_message = {"role": "user", "content": user_input}
+    used = (
+        REPLY_OVERHEAD
+        + message_tokens(system_prompt, model)
+        + message_tokens(user_input, model)
+    )
+
+    candidates = list(zip(ids if ids is not None else [None] * len(context_texts), context_texts))
+
+    def choose(seen):
+        # 既にプロンプトにある文章を除いた上位k件と、除いた分を埋める候補
+        selected = [(i, text) for i, text in candidates[:k] if i not in seen]
+        deduped = len(candidates[:k]) - len(selected)
+        extra = [(i, text) for i, text in candidates[k:] if i not in seen]
+        return selected + extra[:min(deduped, refill)], deduped
+
+    def reserve(selected):
+        return fit_context([text for _, text in selected], budget - used, model)[2]
+
+    # ---- 履歴（新しいものから入るだけ入れる。このターンの参考文章の分は先に確保しておく） ----
+    seen = set()
+    selected, deduped = choose(seen)
+    reserved = reserve(selected)
+    kept = []
+    for message in reversed(history):
+        cost = message_tokens(message["content"], model)
+        if is_context(message):
+            # 前のターンの参考文章は、今回の候補だけでできていて、そこにある文章を送らずに済む分を
+            # 差し引いて予算に収まるときだけ残す（収まらなければ飛ばす）
+            if ids is None or not set(message["chunk_ids"]) <= set(ids):
+                continue
+            next_selected, next_deduped = choose(seen | set(message["chunk_ids"]))
+            next_reserved = reserve(next_selected)
+            if used + cost + next_reserved > budget:
+                continue
+            seen |= set(message["chunk_ids"])
+            selected, deduped, reserved = next_selected, next_deduped, next_reserved
+        elif used + cost + reserved > budget:
+            break
+        kept.append(message)
+        used += cost
+    kept.reverse()
+
+    # ---- 参考文章（プロンプトに残った前のターンの参考文章にあるものは送り直さない） ----
+    texts, truncated, cost = fit_context([text for _, text in selected], budget - used, model)
+    used += cost
+
+    messages = [system_message]
+    # chunk_ids などの記録用のキーはAPIに送らない
+    messages.extend({"role": m["role"], "content": m["content"]} for m in kept)
+    if texts:
+        messages.append(context_message(texts))
+    messages.append(user_message)
+
+    # 全文を入れた文章だけを記録する（切り詰めたものは次のターンで送り直す）
+    sent_ids = [i for i, _ in selected[:len(texts) - truncated]]
+    context = context_message(texts, sent_ids) if ids is not None and sent_ids else None
+
+    plan = {
+        "planned_tokens": used,
+        "budget": budget,
+        "context_chunks": len(texts),
+        "truncated_chunks": truncated,
+        "dropped_chunks": len(selected) - len(texts),
+        "deduped_chunks": deduped,
+        "history_messages": len(kept),
+        "dropped_history": len(history) - len(kept),
+    }
+    return messages, plan, context
+
+
+def format_plan(plan, usage=None):
+    line = (
+        f"prompt | planned: {plan['planned_tokens']}/{plan['budget']}, "
+        f"context: {plan['context_chunks']} chunks, history: {plan['history_messages']} messages"
+    )
+    if plan.get("deduped_chunks"):
+        line += f" ({plan['deduped_chunks']} already in history, not resent)"
+    if usage is not None:
+        line += f", actual: {usage.prompt_tokens}"
+    return line
@@ -0,0 +1,156 @@
+import os
+import json
+import argparse
+import numpy as np
+
+from retriever import (
+    TOP_K, BLOCK_ROWS, ExactRetriever, evaluate, prepare_queries, rerank, sample_queries, stack_results,
+    top_k,
+)
+from store import atomic_open, load_index
+
+# インデックスディレクトリに embeddings.npy と並べて保存する
+# float16 は走査のたびにfloat32へ戻す分だけ厳密検索より遅く、メモリの節約は store.py --dtype float16 と同じなので置かない
+SQ_MODES = ("int8",)
+SQ_META_FILE = "sq_{mode}.json"
+SQ_CODES_FILE = "sq_{mode}.npy"           # 圧縮したベクトル (N, D)
+SQ_PARAMS_FILE = "sq_{mode}_params.npy"   # int8のみ: 次元ごとの [offset, scale] (2, D)
+
+RERANK = int(os.getenv("SQ_RERANK", "50"))   # 元の精度で計算し直す候補数
+
+
+def quantize_int8(embeddings):
+    # 次元ごとの最小・最大で [-128, 127] に線形に割り当てる: x ≈ offset + scale * code
+    lo = np.full(embeddings.shape[1], np.inf, dtype=np.float32)
+    hi = np.full(embeddings.shape[1], -np.inf, dtype=np.float32)
+    for start in range(0, len(embeddings), BLOCK_ROWS):
+        block = np.asarray(embeddings[start:start + BLOCK_ROWS], dtype=np.float32)
+        lo = np.minimum(lo, block.min(axis=0))
+        hi = np.maximum(hi, block.max(axis=0))
+
+    scale = np.maximum(hi - lo, 1e-12) / 255
+    offset = lo + 128 * scale
+
+    codes = np.empty(embeddings.shape, dtype=np.int8)
+    for start in range(0, len(embeddings), BLOCK_ROWS):
+        block = np.asarray(embeddings[start:start + BLOCK_ROWS], dtype=np.float32)
+        codes[start:start + len(block)] = np.clip(np.rint((block - offset) / scale), -128, 127)
+
+    return codes, np.stack([offset, scale]).astype(np.float32)
+
+
+class ScalarQuantizedIndex:
+    """圧縮したベクトルで全件を粗く走査し、上位候補だけを元の精度で並べ直す"""
+
+    def __init__(self, embeddings, codes, mode, params=None, rerank=RERANK):
+        self.embeddings = embeddings
+        self.codes = codes
+        self.mode = mode
+        self.params = params
+        self.rerank = rerank
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + (self.params.nbytes if self.params is not None else 0)
+
+    @classmethod
+    def build(cls, embeddings, mode="int8", rerank=RERANK):
+        if mode not in SQ_MODES:
+            raise ValueError(f"mode must be one of {SQ_MODES}: {mode}")
+        codes, params = quantize_int8(embeddings)
+        return cls(embeddings, codes, mode, params, rerank)
+
+    def save(self, path):
+        with atomic_open(os.path.join(path, SQ_CODES_FILE.format(mode=self.mode))) as f:
+            np.save(f, self.codes)
+        if self.params is not None:
+            with atomic_open(os.path.join(path, SQ_PARAMS_FILE.format(mode=self.mode))) as f:
+                np.save(f, self.params)
+        with atomic_open(os.path.join(path, SQ_META_FILE.format(mode=self.mode)), "w", encoding="utf-8") as f:
+            json.dump({"mode": self.mode, "count": len(self)}, f)
+
+    @classmethod
+    def load(cls, index, mode="int8", rerank=RERANK):
+        meta_path = os.path.join(index.path, SQ_META_FILE.format(mode=mode))
+        if not os.path.exists(meta_path):
+            raise FileNotFoundError(
+                f"{meta_path} がありません。python quant.py {index.path} --mode {mode} で作成してください"
+            )
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta["count"] != len(index):
+            raise ValueError(
+                f"{mode} index is stale ({meta['count']} != {len(index)} chunks); rebuild with quant.py"
+            )
+
+        params = None
+        if mode == "int8":
+            params = np.load(os.path.join(index.path, SQ_PARAMS_FILE.format(mode=mode)))
+        codes = np.load(os.path.join(index.path, SQ_CODES_FILE.format(mode=mode)), mmap_mode="r")
+        return cls(index.embeddings, codes, mode, params, rerank)
+
+    def score(self, queries):
+        # int8: q・x = q・offset + (q * scale)・code なので、codeのまま行列積を取れる
+        if self.params is not None:
+            offset, scale = self.params
+            bias = queries @ offset
+            queries = queries * scale
+        else:
+            bias = 0.0
+
+        n = len(self.codes)
+        scores = np.empty((len(queries), n), dtype=np.float32)
+        for start in range(0, n, BLOCK_ROWS):
+            block = np.asarray(self.codes[start:start + BLOCK_ROWS], dtype=np.float32)
+            scores[:, start:start + len(block)] = queries @ block.T
+        return scores + np.reshape(bias, (-1, 1))
+
+    def search(self, query_vec, k=TOP_K, rerank_candidates=None):
+        queries, single = prepare_queries(query_vec)
+        n_cand = self.rerank if rerank_candidates is None else rerank_candidates
+        coarse_scores, coarse_ids = top_k(self.score(queries), max(k, n_cand))
+
+        # rerank_candidates=0 なら粗い走査の結果をそのまま返す
+        if n_cand == 0:
+            results = [(s[:k], i[:k]) for s, i in zip(coarse_scores, coarse_ids)]
+        else:
+            results = [rerank(self.embeddings, q, c, k) for q, c in zip(queries, coarse_ids)]
+        return stack_results(results, k, single)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="スカラー量子化インデックスを作成し、メモリ量とrecallを表示する")
+    parser.add_argument("index", nargs="?", default=os.getenv("INDEX_DIR", "kenji_index"))
+    parser.add_argument("--mode", choices=SQ_MODES, default="int8")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=TOP_K)
+    args = parser.parse_args()
+
+    index = load_index(args.index)
+    sq = ScalarQuantizedIndex.build(index.embeddings, args.mode)
+    sq.save(args.index)
+
+    full_bytes = len(index) * index.embeddings.shape[1] * 4
+    print(f"{len(index)} chunks, {args.mode}: {sq.nbytes / 2**20:.1f} MiB "
+          f"(float32: {full_bytes / 2**20:.1f} MiB, {full_bytes / max(sq.nbytes, 1):.1f}x smaller)")
+
+    exact = ExactRetriever(index.embeddings)
+    queries = sample_queries(index.embeddings, args.queries)
+    recall, exact_latency = evaluate(exact, exact, queries, args.k)
+    print(f"exact              recall@{args.k}={recall:.3f}  {exact_latency:.2f} ms/query")
+    slower = False
+    for n_cand in (0, args.k * 4, RERANK):
+        recall, latency = evaluate(sq, exact, queries, args.k, rerank_candidates=n_cand)
+        slower |= latency > exact_latency
+        print(f"rerank={n_cand:<4d}        recall@{args.k}={recall:.3f}  {latency:.2f} ms/query "
+              f"({exact_latency / latency:.2f}x exact throughput)")
+    # 走査のたびに float32 へ戻すので、メモリに収まるコーパスでは厳密検索より遅いことがある
+    if slower:
+        print(f"note: {args.mode} is slower than exact here; use it only when the float32 index does not fit in memory")
+
+
+if __name__ == "__main__":
+    main()
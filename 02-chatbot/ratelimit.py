@@ -0,0 +1,225 @@
+import os
+import time
+import heapq
+import random
+import asyncio
+import itertools
+import threading
+
+import openai
+
+# 優先度（小さいほど先）: 対話中のターンをバッチ処理より先に通す
+INTERACTIVE = 0
+BULK = 10
+
+MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "6"))
+POLL_INTERVAL = 0.05   # 順番待ちの再確認間隔（秒）
+RETRY_AFTER_JITTER = 0.5   # Retry-After に足すランダムな待ち時間の幅（Retry-After に対する割合）
+MIN_JITTER = 0.25          # Retry-After がごく短くても、これ×2^試行回数 秒の幅には散らす
+
+# リトライ対象のエラー（レート制限・一時的な障害）
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+
+
+def retry_delay(error, attempt):
+    # Retry-After ヘッダがあればそれ以上待ち、なければ指数バックオフ。どちらもジッターを足して、
+    # 同時に断られた呼び出しが同じ瞬間に再送しないようにする
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        if retry_after:
+            try:
+                retry_after = float(retry_after)
+            except ValueError:
+                pass
+            else:
+                spread = max(retry_after * RETRY_AFTER_JITTER, min(60.0, MIN_JITTER * 2 ** attempt))
+                return retry_after + random.random() * spread
+    return min(60.0, 2 ** attempt) * (0.5 + random.random() / 2)
+
+
+class TokenBucket:
+    """1分あたり rate_per_minute 個まで。rate_per_minute が 0 なら無制限"""
+
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.level = self.capacity
+        self.fill_rate = self.capacity / 60
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.fill_rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        if not self.capacity:
+            return 0.0
+        self._refill()
+        # 容量より大きい要求は満タンになれば通す
+        need = min(amount, self.capacity)
+        return 0.0 if self.level >= need else (need - self.level) / self.fill_rate
+
+    def consume(self, amount):
+        if self.capacity:
+            self._refill()
+            self.level = min(self.capacity, self.level - amount)
+
+
+class RateLimiter:
+    """RPM・TPMのトークンバケットと優先度付きの順番待ち"""
+
+    def __init__(self, rpm=0, tpm=0):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self._cond = threading.Condition()
+        self._waiting = []            # (優先度, 到着順) のヒープ
+        self._seq = itertools.count()
+        self.granted = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.wait_seconds = 0.0
+
+    def _try_acquire(self, ticket, estimate):
+        # 先頭の順番のときだけ枠を取る。戻り値は待つべき秒数（0なら取得済み）
+        if self._waiting[0] != ticket:
+            return None
+        wait = max(self.requests.wait_time(1), self.tokens.wait_time(estimate))
+        if wait > 0:
+            return wait
+        heapq.heappop(self._waiting)
+        self.requests.consume(1)
+        self.tokens.consume(estimate)
+        self.granted += 1
+        return 0.0
+
+    def acquire(self, estimate, priority=INTERACTIVE):
+        start = time.monotonic()
+        with self._cond:
+            ticket = (priority, next(self._seq))
+            heapq.heappush(self._waiting, ticket)
+            while True:
+                wait = self._try_acquire(ticket, estimate)
+                if wait == 0:
+                    # 次の順番の人を起こす
+                    self._cond.notify_all()
+                    break
+                self._cond.wait(timeout=min(wait or POLL_INTERVAL, POLL_INTERVAL))
+        self.wait_seconds += time.monotonic() - start
+
+    async def acquire_async(self, estimate, priority=INTERACTIVE):
+        start = time.monotonic()
+        with self._cond:
+            ticket = (priority, next(self._seq))
+            heapq.heappush(self._waiting, ticket)
+        try:
+            while True:
+                with self._cond:
+                    wait = self._try_acquire(ticket, estimate)
+                    if wait == 0:
+                        self._cond.notify_all()
+                        break
+                await asyncio.sleep(min(wait or POLL_INTERVAL, POLL_INTERVAL))
+        except asyncio.CancelledError:
+            # 待っている間にキャンセルされたら順番待ちから外す
+            with self._cond:
+                if ticket in self._waiting:
+                    self._waiting.remove(ticket)
+                    heapq.heapify(self._waiting)
+                    self._cond.notify_all()
+            raise
+        self.wait_seconds += time.monotonic() - start
+
+    def settle(self, estimate, actual):
+        # 呼び出し後に response.usage の実際のトークン数で見積もりとの差を補正する
+        if actual is not None:
+            with self._cond:
+                self.tokens.consume(actual - estimate)
+
+    def _on_error(self, error):
+        self.retries += 1
+        if isinstance(error, openai.RateLimitError):
+            self.rate_limited += 1
+
+    def call(self, fn, estimate, priority=INTERACTIVE, usage_tokens=None, max_retries=MAX_RETRIES):
+        # fn() を枠を取ってから呼び、レート制限・一時的な障害はジッター付きでリトライする
+        for attempt in range(max_retries + 1):
+            self.acquire(estimate, priority)
+            try:
+                result = fn()
+            except RETRYABLE_ERRORS as e:
+                self._on_error(e)
+                if attempt == max_retries:
+                    raise
+                time.sleep(retry_delay(e, attempt))
+                continue
+            if usage_tokens is not None:
+                self.settle(estimate, usage_tokens(result))
+            return result
+
+    async def acall(self, fn, estimate, priority=INTERACTIVE, usage_tokens=None, max_retries=MAX_RETRIES):
+        # call() の async 版。fn はコルーチンを返す関数
+        for attempt in range(max_retries + 1):
+            await self.acquire_async(estimate, priority)
+            try:
+                result = await fn()
+            except RETRYABLE_ERRORS as e:
+                self._on_error(e)
+                if attempt == max_retries:
+                    raise
+                await asyncio.sleep(retry_delay(e, attempt))
+                continue
+            if usage_tokens is not None:
+                self.settle(estimate, usage_tokens(result))
+            return result
+
+    def stats(self):
+        return {
+            "granted": self.granted,
+            "waiting": len(self._waiting),
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+            "wait_seconds": round(self.wait_seconds, 3),
+        }
+
+
+class UpstreamScheduler:
+    """上流（OpenAI）への呼び出しはすべてここを通す。モデルごとに別の枠を持つ"""
+
+    def __init__(self, chat_rpm=0, chat_tpm=0, embedding_rpm=0, embedding_tpm=0):
+        self.chat = RateLimiter(chat_rpm, chat_tpm)
+        self.embeddings = RateLimiter(embedding_rpm, embedding_tpm)
+
+    def stats(self):
+        return {"chat": self.chat.stats(), "embeddings": self.embeddings.stats()}
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    # プロセスで1つだけ作る（CLI・Streamlitの全セッション・サーバーで共有する）
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = UpstreamScheduler(
+                chat_rpm=int(os.getenv("CHAT_RPM", "0")),
+                chat_tpm=int(os.getenv("CHAT_TPM", "0")),
+                embedding_rpm=int(os.getenv("EMBEDDING_RPM", "0")),
+                embedding_tpm=int(os.getenv("EMBEDDING_TPM", "0")),
+            )
+        return _scheduler
+
+
+def format_scheduler_stats(stats):
+    return " / ".join(
+        f"{name}: {s['granted']} calls, {s['retries']} retries ({s['rate_limited']} rate limited), "
+        f"waited {s['wait_seconds']:.1f}s"
+        for name, s in stats.items()
+    )
@@ -0,0 +1,190 @@
+import time
+import numpy as np
+
+from store import l2_normalize
+
+TOP_K = 3
+BLOCK_ROWS = 65536   # 一度に内積を取る行数（float16などの変換で一時メモリが膨らまないように）
+
+
+def top_k(scores, k):
+    # 全件ソートせず、argpartitionで上位k件だけ取り出してから並べる: O(n + k log k)
+    k = min(k, scores.shape[-1])
+    if k <= 0:
+        empty = np.zeros(scores.shape[:-1] + (0,))
+        return empty, empty.astype(np.int64)
+
+    if k < scores.shape[-1]:
+        ids = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    else:
+        ids = np.broadcast_to(np.arange(k), scores.shape[:-1] + (k,))
+    top_scores = np.take_along_axis(scores, ids, axis=-1)
+
+    order = np.argsort(-top_scores, axis=-1, kind="stable")
+    return (
+        np.take_along_axis(top_scores, order, axis=-1),
+        np.take_along_axis(ids, order, axis=-1),
+    )
+
+
+def prepare_queries(query_vec):
+    # 1本でも複数本でも (Q, D) の正規化済み行列にそろえる
+    query_vec = np.asarray(query_vec, dtype=np.float32)
+    return l2_normalize(np.atleast_2d(query_vec)), query_vec.ndim == 1
+
+
+class ExactRetriever:
+    """正規化済みベクトルとの内積（コサイン類似度）で全件を走査する"""
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def score(self, queries):
+        # 複数クエリを1回の行列積でまとめてscore化する
+        n = len(self.embeddings)
+        scores = np.empty((len(queries), n), dtype=np.float32)
+        for start in range(0, n, BLOCK_ROWS):
+            block = np.asarray(self.embeddings[start:start + BLOCK_ROWS], dtype=np.float32)
+            scores[:, start:start + len(block)] = queries @ block.T
+        return scores
+
+    def search(self, query_vec, k=TOP_K):
+        # 戻り値は (scores, ids)。query_vecが1本なら (k,)、行列なら (Q, k)
+        queries, single = prepare_queries(query_vec)
+        scores, ids = top_k(self.score(queries), k)
+        if single:
+            return scores[0], ids[0]
+        return scores, ids
+
+
+def uses_embedding(retriever):
+    # BM25だけで検索する場合はクエリのembeddingが要らない
+    return getattr(retriever, "uses_embedding", True)
+
+
+def search(retriever, query_vec, k, query_text=None):
+    # 方式によって検索に使うものが違う: ベクトルだけ・テキストだけ・両方
+    if getattr(retriever, "uses_text", False):
+        return retriever.search(query_vec, k, query_text=query_text)
+    if not uses_embedding(retriever):
+        return retriever.search(query_text, k)
+    return retriever.search(query_vec, k)
+
+
+def traced_search(retriever, query_vec, k, trace, query_text=None):
+    # 全件走査では score 計算と上位k件の選択を別々に計測する（他の方式は検索全体を scoring として計る）
+    if not isinstance(retriever, ExactRetriever):
+        with trace.stage("scoring"):
+            return search(retriever, query_vec, k, query_text)
+
+    queries, single = prepare_queries(query_vec)
+    with trace.stage("scoring"):
+        scores = retriever.score(queries)
+    with trace.stage("top_k"):
+        scores, ids = top_k(scores, k)
+    if single:
+        return scores[0], ids[0]
+    return scores, ids
+
+
+def stack_results(results, k, single):
+    # クエリごとに件数が違う結果を (Q, k) にそろえる（足りない分は id=-1, score=-inf）
+    if single:
+        return results[0]
+    scores = np.full((len(results), k), -np.inf, dtype=np.float32)
+    ids = np.full((len(results), k), -1, dtype=np.int64)
+    for row, (s, i) in enumerate(results):
+        scores[row, :len(s)] = s
+        ids[row, :len(i)] = i
+    return scores, ids
+
+
+def rerank(embeddings, query, candidates, k):
+    # 候補だけを元の精度のベクトルで計算し直す（番号順に読むとmmapのアクセスが前から順になる）
+    candidates = np.sort(np.asarray(candidates))
+    vectors = np.asarray(embeddings[candidates], dtype=np.float32)
+    scores, order = top_k(vectors @ query, k)
+    return scores, candidates[order]
+
+
+def recall_at_k(approx_ids, exact_ids):
+    # 厳密検索の上位k件のうち、近似検索が拾えた割合の平均
+    approx_ids = np.atleast_2d(approx_ids)
+    exact_ids = np.atleast_2d(exact_ids)
+    hits = [
+        len(set(a.tolist()) & set(e.tolist()) - {-1}) / max(len(e), 1)
+        for a, e in zip(approx_ids, exact_ids)
+    ]
+    return float(np.mean(hits))
+
+
+def sample_queries(embeddings, n, noise=0.05, seed=0):
+    # コーパス中のベクトルに雑音を加えたものを擬似クエリとする
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(embeddings), min(n, len(embeddings)), replace=False)
+    queries = np.asarray(embeddings[np.sort(rows)], dtype=np.float32)
+    queries += rng.normal(scale=noise / np.sqrt(queries.shape[1]), size=queries.shape)
+    return l2_normalize(queries)
+
+
+def evaluate(retriever, exact, queries, k=TOP_K, **search_kwargs):
+    # 厳密検索に対する recall@k と1クエリあたりの平均レイテンシ(ms)
+    _, exact_ids = exact.search(queries, k)
+    start = time.perf_counter()
+    approx_ids = [retriever.search(q, k, **search_kwargs)[1] for q in queries]
+    latency = (time.perf_counter() - start) / len(queries) * 1000
+    recall = float(np.mean([recall_at_k(a, e) for a, e in zip(approx_ids, exact_ids)]))
+    return recall, latency
+
+
+def _ivf_retriever(index):
+    # ann は retriever を import するので循環しないよう遅延importする
+    from ann import IVFIndex
+    return IVFIndex.load(index)
+
+
+def _sq_retriever(mode):
+    def load(index):
+        from quant import ScalarQuantizedIndex
+        return ScalarQuantizedIndex.load(index, mode)
+    return load
+
+
+def _pq_retriever(index):
+    from pq import PQIndex
+    return PQIndex.load(index)
+
+
+def _bm25_retriever(index):
+    from lexical import BM25Index
+    return BM25Index.load(index)
+
+
+def _hybrid_retriever(index):
+    from lexical import HYBRID_DENSE_MODE, BM25Index, HybridRetriever
+    return HybridRetriever(make_retriever(index, HYBRID_DENSE_MODE), BM25Index.load(index))
+
+
+RETRIEVERS = {
+    "exact": lambda index: ExactRetriever(index.embeddings),
+    "ivf": _ivf_retriever,
+    "int8": _sq_retriever("int8"),
+    "pq": _pq_retriever,
+    "bm25": _bm25_retriever,
+    "hybrid": _hybrid_retriever,
+}
+
+
+def make_retriever(index, mode="exact", diversify=False):
+    # diversify=True なら、検索結果をMMRと作品ごとの上限で選び直す（diversify.py）
+    if mode not in RETRIEVERS:
+        raise ValueError(f"unknown retrieval mode: {mode} (choose from {sorted(RETRIEVERS)})")
+    retriever = RETRIEVERS[mode](index)
+    if diversify:
+        from diversify import DiversifiedRetriever
+        retriever = DiversifiedRetriever(retriever, index)
+    return retriever
+
@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import argparse
+from collections import OrderedDict
+
+from aiohttp import web
+from dotenv import load_dotenv
+from openai import AsyncOpenAI
+
+from answer_cache import AnswerCache
+from embed_cache import EmbeddingCache
+from engine import AsyncChatEngine, Conversation as BaseConversation
+from gate import RetrievalGate
+from metrics import Metrics
+from ratelimit import get_scheduler
+from retriever import make_retriever
+from store import load_index
+
+load_dotenv()
+
+API_KEY = os.getenv("OPENAI_API_KEY")
+MODEL_NAME = os.getenv("MODEL_NAME")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL")
+INDEX_DIR = os.getenv("INDEX_DIR", "kenji_index")
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "exact")
+DIVERSIFY = os.getenv("DIVERSIFY", "0") != "0"   # 1 なら似た参考文章・同じ作品ばかりにならないよう選び直す
+TOP_K = 3
+
+MAX_CONVERSATIONS = int(os.getenv("MAX_CONVERSATIONS", "10000"))  # 超えたら古い会話から捨てる
+
+
+def usage_dict(usage):
+    if usage is None:
+        return None
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens,
+        "total_tokens": usage.total_tokens,
+    }
+
+
+class Conversation(BaseConversation):
+    def __init__(self):
+        super().__init__()
+        # 同じ会話へのメッセージは1件ずつ処理する
+        self.lock = asyncio.Lock()
+
+
+class ChatService:
+    """インデックスをプロセスで1回だけ読み込み、会話ごとの履歴をサーバー側で持つ"""
+
+    def __init__(self, index_dir=INDEX_DIR, retrieval_mode=RETRIEVAL_MODE, client=None):
+        self.metrics = Metrics()
+        start = time.perf_counter()
+        index = load_index(index_dir)
+        self.chunks = index.chunks
+        retriever = make_retriever(index, retrieval_mode, diversify=DIVERSIFY)
+        self.metrics.observe("index_load", (time.perf_counter() - start) * 1000)
+        # リトライはスケジューラが行う（SDK側でも繰り返すと枠や優先度を通らない呼び出しが増える）
+        client = client or AsyncOpenAI(api_key=API_KEY, max_retries=0)
+        self.answer_cache = AnswerCache()
+        self.embed_cache = EmbeddingCache()
+        self.gate = RetrievalGate()
+        self.scheduler = get_scheduler()
+        self.engine = AsyncChatEngine(
+            client, self.chunks, retriever, MODEL_NAME, EMBEDDING_MODEL, self.answer_cache, self.embed_cache,
+            self.gate, self.metrics, self.scheduler, top_k=TOP_K,
+        )
+        self.conversations = OrderedDict()
+
+    def create_conversation(self):
+        conversation_id = uuid.uuid4().hex
+        self.conversations[conversation_id] = Conversation()
+        while len(self.conversations) > MAX_CONVERSATIONS:
+            self.conversations.popitem(last=False)
+        return conversation_id
+
+    def get_conversation(self, conversation_id):
+        conversation = self.conversations.get(conversation_id)
+        if conversation is not None:
+            self.conversations.move_to_end(conversation_id)
+        return conversation
+
+    async def reply(self, conversation, user_input):
+        # (イベント名, データ) を順に返す: delta を何回か送ったあと最後に done
+        async for event, data in self.engine.areply(conversation, user_input):
+            if event == "delta":
+                yield "delta", {"content": data}
+                continue
+            data = dict(data)
+            del data["answer"]
+            if not data["cached"]:
+                data["usage"] = usage_dict(data["usage"])
+            yield "done", data
+
+
+async def create_conversation(request):
+    service = request.app["service"]
+    return web.json_response({"id": service.create_conversation()}, status=201)
+
+
+async def get_conversation(request):
+    service = request.app["service"]
+    conversation = service.get_conversation(request.match_info["id"])
+    if conversation is None:
+        raise web.HTTPNotFound()
+    return web.json_response({"history": conversation.history}, dumps=lambda o: json.dumps(o, ensure_ascii=False))
+
+
+async def delete_conversation(request):
+    service = request.app["service"]
+    if service.conversations.pop(request.match_info["id"], None) is None:
+        raise web.HTTPNotFound()
+    return web.Response(status=204)
+
+
+async def post_message(request):
+    service = request.app["service"]
+    conversation = service.get_conversation(request.match_info["id"])
+    if conversation is None:
+        raise web.HTTPNotFound()
+
+    body = await request.json()
+    user_input = body.get("content", "").strip()
+    if not user_input:
+        raise web.HTTPBadRequest(text="content is required")
+
+    # Server-Sent Events で生成された分から順に送る
+    response = web.StreamResponse(headers={
+        "Content-Type": "text/event-stream; charset=utf-8",
+        "Cache-Control": "no-cache",
+    })
+    await response.prepare(request)
+
+    async with conversation.lock:
+        try:
+            async for event, data in service.reply(conversation, user_input):
+                payload = json.dumps(data, ensure_ascii=False)
+                await response.write(f"event: {event}\ndata: {payload}\n\n".encode("utf-8"))
+        except ConnectionResetError:
+            # クライアントが途中で切断した
+            return response
+        except Exception as e:
+            payload = json.dumps({"error": type(e).__name__, "message": str(e)}, ensure_ascii=False)
+            await response.write(f"event: error\ndata: {payload}\n\n".encode("utf-8"))
+
+    await response.write_eof()
+    return response
+
+
+async def health(request):
+    service = request.app["service"]
+    return web.json_response({
+        "chunks": len(service.chunks),
+        "conversations": len(service.conversations),
+        "answer_cache": service.answer_cache.stats(),
+        "embedding_cache": service.embed_cache.stats(),
+        "embedding_batches": service.engine.embed_batcher.stats(),
+        "search_batches": service.engine.search_batcher.stats(),
+        "upstream": service.scheduler.stats(),
+        "retrieval_gate": service.gate.stats(),
+    })
+
+
+async def metrics(request):
+    # Prometheus のテキスト形式
+    service = request.app["service"]
+    return web.Response(text=service.metrics.prometheus(), content_type="text/plain")
+
+
+def make_app(service):
+    app = web.Application()
+    app["service"] = service
+    app.add_routes([
+        web.post("/conversations", create_conversation),
+        web.get("/conversations/{id}", get_conversation),
+        web.delete("/conversations/{id}", delete_conversation),
+        web.post("/conversations/{id}/messages", post_message),
+        web.get("/healthz", health),
+        web.get("/metrics", metrics),
+    ])
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="賢治botのHTTPサーバー（返答はSSEでストリーミング）")
+    parser.add_argument("--host", default=os.getenv("HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8080")))
+    args = parser.parse_args()
+
+    web.run_app(make_app(ChatService()), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+import os
+import json
+import pickle
+import argparse
+import contextlib
+from array import array
+import numpy as np
+
+# インデックスディレクトリ内のファイル構成
+META_FILE = "meta.json"
+EMBEDDINGS_FILE = "embeddings.npy"   # 正規化済みベクトル (N, D)
+TEXTS_FILE = "texts.bin"             # チャンク本文をUTF-8で連結したもの
+OFFSETS_FILE = "offsets.npy"         # texts.bin内の各チャンクの開始位置 (N + 1,)
+SOURCE_IDS_FILE = "source_ids.npy"   # チャンクごとの出典番号 (N,)
+SPANS_FILE = "spans.npy"             # チャンクの元ファイル内の位置 [start, end) (N, 2)。分かる場合だけ
+
+DTYPES = ("float32", "float16")
+
+
+def l2_normalize(x):
+    # ゼロベクトルで割らないようにノルム0は1として扱う
+    x = np.asarray(x, dtype=np.float32)
+    norm = np.linalg.norm(x, axis=-1, keepdims=True)
+    norm[norm == 0] = 1.0
+    return x / norm
+
+
+@contextlib.contextmanager
+def atomic_open(path, mode="wb", **kwargs):
+    # 一時ファイルに書いてから置き換える。mmap中の旧ファイルはそのまま読み続けられる
+    tmp_path = path + ".tmp"
+    with open(tmp_path, mode, **kwargs) as f:
+        yield f
+    os.replace(tmp_path, path)
+
+
+class ChunkStore:
+    """texts.bin をmmapし、chunks[i] で {"text", "source"} を返すリスト風のオブジェクト"""
+
+    def __init__(self, path, sources):
+        self._offsets = np.load(os.path.join(path, OFFSETS_FILE), mmap_mode="r")
+        self.source_ids = np.load(os.path.join(path, SOURCE_IDS_FILE), mmap_mode="r")
+        self.sources = sources
+        spans_path = os.path.join(path, SPANS_FILE)
+        self.spans = np.load(spans_path, mmap_mode="r") if os.path.exists(spans_path) else None
+
+        # 空ファイルはmmapできないので空配列で代用
+        texts_path = os.path.join(path, TEXTS_FILE)
+        if os.path.getsize(texts_path) > 0:
+            self._texts = np.memmap(texts_path, dtype=np.uint8, mode="r")
+        else:
+            self._texts = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        start, end = int(self._offsets[i]), int(self._offsets[i + 1])
+        chunk = {
+            "text": self._texts[start:end].tobytes().decode("utf-8"),
+            "source": self.sources[self.source_ids[i]],
+        }
+        if self.spans is not None:
+            chunk["start"], chunk["end"] = int(self.spans[i, 0]), int(self.spans[i, 1])
+        return chunk
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class Index:
+    def __init__(self, path, embeddings, chunks, meta):
+        self.path = path
+        self.embeddings = embeddings
+        self.chunks = chunks
+        self.meta = meta
+
+    def __len__(self):
+        return len(self.chunks)
+
+
+class IndexWriter:
+    """チャンクを1件ずつ書き出してインデックスを作る（本文もベクトルもまとめてメモリに載せない）
+
+    add() で本文を texts.bin に追記し、全件追加したあとで write_embeddings() で
+    embeddings.npy（mmapで開いた (N, D) の配列）に行ごとにベクトルを書き込む。
+    close() で残りのファイルと meta.json を書く。書き込み中は一時ファイルに書くので、
+    close() するまでは前回のインデックスをそのまま読める。
+    """
+
+    def __init__(self, path, dtype="float32"):
+        if dtype not in DTYPES:
+            raise ValueError(f"dtype must be one of {DTYPES}: {dtype}")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.dtype = dtype
+        self.sources = []
+        self._source_index = {}
+        self._offsets = array("q", [0])
+        self._source_ids = array("i")
+        self._spans = array("q")      # start, end の順に並べる
+        self._has_spans = True
+        self._texts_file = open(self._tmp(TEXTS_FILE), "wb")
+        self._texts = None
+        self._embeddings = None
+        self._written = None
+
+    def _tmp(self, name):
+        return os.path.join(self.path, name) + ".tmp"
+
+    def __len__(self):
+        return len(self._source_ids)
+
+    def add(self, chunk):
+        data = chunk["text"].encode("utf-8")
+        self._texts_file.write(data)
+        self._offsets.append(self._offsets[-1] + len(data))
+
+        source = chunk["source"]
+        if source not in self._source_index:
+            self._source_index[source] = len(self.sources)
+            self.sources.append(source)
+        self._source_ids.append(self._source_index[source])
+
+        if self._has_spans and "start" in chunk:
+            self._spans.extend((chunk["start"], chunk["end"]))
+        else:
+            self._has_spans = False
+        return len(self) - 1
+
+    def _finish_texts(self):
+        # 本文を書き終えて、読み返せるようにmmapする（空ファイルはmmapできないので空配列で代用）
+        if self._texts_file.closed:
+            return
+        self._texts_file.close()
+        if os.path.getsize(self._tmp(TEXTS_FILE)) > 0:
+            self._texts = np.memmap(self._tmp(TEXTS_FILE), dtype=np.uint8, mode="r")
+        else:
+            self._texts = np.zeros(0, dtype=np.uint8)
+
+    def text(self, i):
+        # 追加し終えたチャンクの本文を読み返す（ベクトル化のときに使う）
+        self._finish_texts()
+        return self._texts[self._offsets[i]:self._offsets[i + 1]].tobytes().decode("utf-8")
+
+    def write_embeddings(self, rows, vectors):
+        # 最初に書き込むときに次元数が決まるので、そこで (N, D) の配列を作る
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self._embeddings is None:
+            self._finish_texts()
+            self._embeddings = np.lib.format.open_memmap(
+                self._tmp(EMBEDDINGS_FILE), mode="w+", dtype=self.dtype, shape=(len(self), vectors.shape[1])
+            )
+            self._written = np.zeros(len(self), dtype=bool)
+        # 読み込み時に毎回正規化しなくて済むよう、正規化済みで保存する
+        self._embeddings[rows] = l2_normalize(vectors).astype(self.dtype)
+        self._written[rows] = True
+
+    def close(self, meta=None):
+        self._finish_texts()
+        if self._embeddings is None or not self._written.all():
+            missing = len(self) if self._written is None else int(np.sum(~self._written))
+            raise ValueError(f"{missing} of {len(self)} chunks have no embedding")
+
+        dim = int(self._embeddings.shape[1])
+        self._embeddings.flush()
+        self._embeddings = self._texts = None
+        os.replace(self._tmp(EMBEDDINGS_FILE), os.path.join(self.path, EMBEDDINGS_FILE))
+        os.replace(self._tmp(TEXTS_FILE), os.path.join(self.path, TEXTS_FILE))
+
+        with atomic_open(os.path.join(self.path, OFFSETS_FILE)) as f:
+            np.save(f, np.frombuffer(self._offsets, dtype=np.int64))
+        with atomic_open(os.path.join(self.path, SOURCE_IDS_FILE)) as f:
+            np.save(f, np.frombuffer(self._source_ids, dtype=np.int32))
+
+        spans_path = os.path.join(self.path, SPANS_FILE)
+        if len(self) and self._has_spans:
+            with atomic_open(spans_path) as f:
+                np.save(f, np.frombuffer(self._spans, dtype=np.int64).reshape(-1, 2))
+        elif os.path.exists(spans_path):
+            os.remove(spans_path)
+
+        # meta.json は最後に書く（途中で落ちた場合に不完全なインデックスを読まないため）
+        meta = dict(meta or {})
+        meta.update({
+            "count": len(self),
+            "dim": dim,
+            "dtype": self.dtype,
+            "sources": self.sources,
+        })
+        with atomic_open(os.path.join(self.path, META_FILE), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+
+
+def save_index(path, embeddings, chunks, dtype="float32", meta=None):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if embeddings.ndim != 2 or len(embeddings) != len(chunks):
+        raise ValueError(
+            f"embeddings shape {embeddings.shape} does not match {len(chunks)} chunks"
+        )
+
+    writer = IndexWriter(path, dtype)
+    for chunk in chunks:
+        writer.add(chunk)
+    writer.write_embeddings(slice(None), embeddings)
+    writer.close(meta)
+
+
+def load_index(path):
+    meta_path = os.path.join(path, META_FILE)
+    if not os.path.exists(meta_path):
+        raise FileNotFoundError(
+            f"{meta_path} がありません。"
+            f"python store.py kenji_embeddings.json {path} で変換してください"
+        )
+
+    with open(meta_path, encoding="utf-8") as f:
+        meta = json.load(f)
+
+    # mmapで開くのでロードはほぼゼロコスト、ページはプロセス間で共有される
+    embeddings = np.load(os.path.join(path, EMBEDDINGS_FILE), mmap_mode="r")
+    chunks = ChunkStore(path, meta["sources"])
+    return Index(path, embeddings, chunks, meta)
+
+
+def load_legacy(src):
+    # ノートブックが出力した kenji_embeddings.json / kenji_embeddings.pkl を読む
+    if src.endswith(".pkl"):
+        with open(src, "rb") as f:
+            data = pickle.load(f)
+        embeddings = data["embeddings"]
+        chunks = [{"text": c["text"], "source": c["source"]} for c in data["chunks"]]
+    else:
+        with open(src, encoding="utf-8") as f:
+            data = json.load(f)
+        embeddings = [d["embedding"] for d in data]
+        chunks = [{"text": d["text"], "source": d["source"]} for d in data]
+
+    return np.array(embeddings, dtype=np.float32), chunks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSON/pickle形式の埋め込みをバイナリインデックスに変換する")
+    parser.add_argument("src", help="kenji_embeddings.json または kenji_embeddings.pkl")
+    parser.add_argument("dst", help="出力先ディレクトリ (例: kenji_index)")
+    parser.add_argument("--dtype", choices=DTYPES, default="float32")
+    args = parser.parse_args()
+
+    embeddings, chunks = load_legacy(args.src)
+    save_index(args.dst, embeddings, chunks, dtype=args.dtype)
+    print(f"{len(chunks)} chunks, dim={embeddings.shape[1]}, dtype={args.dtype} -> {args.dst}")
+
+
+if __name__ == "__main__":
+    main()
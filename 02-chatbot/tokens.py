@@ -0,0 +1,71 @@
+import functools
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken がなければ文字数からの概算で代用する
+    tiktoken = None
+
+DEFAULT_ENCODING = "o200k_base"
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model=None):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model) if model else tiktoken.get_encoding(DEFAULT_ENCODING)
+    except (KeyError, ValueError):
+        return tiktoken.get_encoding(DEFAULT_ENCODING)
+
+
+def count_tokens(text, model=None):
+    encoding = get_encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text))
+    # 概算: 日本語は1文字≒1トークン、ASCIIは4文字≒1トークン
+    ascii_chars = sum(1 for c in text if c.isascii())
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+
+def truncate_tokens(text, max_tokens, model=None):
+    if max_tokens <= 0:
+        return ""
+    encoding = get_encoding(model)
+    if encoding is not None:
+        ids = encoding.encode(text)
+        return text if len(ids) <= max_tokens else encoding.decode(ids[:max_tokens])
+
+    # 概算の場合は前から数えて収まるところで切る
+    used = 0.0
+    for i, c in enumerate(text):
+        used += 0.25 if c.isascii() else 1.0
+        if used > max_tokens:
+            return text[:i]
+    return text
+
+
+def token_cuts(text, max_tokens, model=None):
+    # text を max_tokens トークンずつに分ける切れ目（文字位置）を返す。エンコードは1回だけ行う
+    encoding = get_encoding(model)
+    if encoding is not None:
+        # トークンが文字の途中から始まる場合、その文字の開始位置が返るので文字を割らずに切れる
+        _, offsets = encoding.decode_with_offsets(encoding.encode(text))
+        positions = offsets[max_tokens::max_tokens]
+    else:
+        positions = []
+        used = 0.0
+        for i, c in enumerate(text):
+            cost = 0.25 if c.isascii() else 1.0
+            if used + cost > max_tokens:
+                positions.append(i)
+                used = 0.0
+            used += cost
+
+    # 1文字も入らない場合でも先に進むように、切れ目は最低1文字ずつ進める
+    cuts = []
+    for position in positions:
+        position = max(position, cuts[-1] + 1 if cuts else 1)
+        if position >= len(text):
+            break
+        cuts.append(position)
+    return cuts